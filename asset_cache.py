@@ -0,0 +1,90 @@
+# --- スケール済みスプライトのキャッシュファイル ---
+# 全スプライト（拡大・左右反転済み）のRGBA画素を1つのファイルにまとめて書き出し、
+# 起動時はメモリマップしてそのままSurfaceにする（PNGの展開と拡大を省き、
+# 同じファイルを開いた複数のプロセスでページを共有できる）
+#
+# ファイル形式:
+#   MAGIC(8バイト) + ヘッダ長(uint32, little endian) + ヘッダ(JSON) + 画素データ
+#   ヘッダ: {"key": 元画像とSCALEから作ったキー, "frames": [[名前, 幅, 高さ, オフセット], ...]}
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+import pygame
+
+MAGIC = b"MARIOAC1"
+HEADER_LEN = struct.Struct("<I")
+ALIGN = 16
+
+def source_key(paths, scale):
+    # 元画像の内容とSCALEが変わったらキーも変わる（キャッシュを作り直す合図）
+    digest = hashlib.sha1(("scale=%r" % (scale,)).encode())
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha1(f.read()).digest())
+    return digest.hexdigest()
+
+def write_cache(path, key, frames):
+    # frames: [(名前, Surface), ...] をキャッシュファイルに書き出す
+    entries = []
+    blobs = []
+    offset = 0
+    for name, surface in frames:
+        data = pygame.image.tobytes(surface, "RGBA")
+        entries.append([name, surface.get_width(), surface.get_height(), offset])
+        blobs.append(data)
+        blobs.append(bytes(-len(data) % ALIGN))
+        offset += len(data) + (-len(data) % ALIGN)
+    header = json.dumps({"key": key, "frames": entries}).encode()
+    # 画素データの先頭もALIGNに揃える
+    header += b" " * (-(len(MAGIC) + HEADER_LEN.size + len(header)) % ALIGN)
+
+    # 複数のプロセスが同時に作り直しても壊れないよう、一時ファイルに書いてから置き換える
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(HEADER_LEN.pack(len(header)))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(tmp_path, path)
+
+def read_cache(path, key):
+    # キャッシュが使えれば (mmap, [(名前, Surface), ...]) を、古いかなければNoneを返す
+    # Surfaceはmmapの画素を直接参照するので、mmapは使い終わるまで保持しておくこと
+    try:
+        f = open(path, "rb")
+    except OSError:
+        return None
+    with f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # 空ファイル
+            return None
+    start = len(MAGIC) + HEADER_LEN.size
+    if buf[:len(MAGIC)] != MAGIC or len(buf) < start:
+        buf.close()
+        return None
+    # 途中で切れたり壊れたりしたファイルも古いキャッシュと同じく作り直させる
+    try:
+        (header_len,) = HEADER_LEN.unpack_from(buf, len(MAGIC))
+        header = json.loads(bytes(buf[start:start + header_len]))
+        stale = header["key"] != key
+        entries = [(name, int(width), int(height), int(offset)) for name, width, height, offset in header["frames"]]
+    except (ValueError, KeyError, TypeError):
+        stale = True
+    data_start = start + header_len
+    if stale or any(width < 0 or height < 0 or offset < 0 or data_start + offset + width * height * 4 > len(buf)
+                    for _, width, height, offset in entries):
+        buf.close()
+        return None
+    view = memoryview(buf)
+    frames = []
+    for name, width, height, offset in entries:
+        begin = data_start + offset
+        pixels = view[begin:begin + width * height * 4]
+        frames.append((name, pygame.image.frombuffer(pixels, (width, height), "RGBA")))
+    return buf, frames
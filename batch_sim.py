@@ -0,0 +1,357 @@
+# --- 多数のマリオをNumPy配列でまとめて動かすバッチシミュレータ ---
+# 同じTILEMAPの上でN体のマリオ（N個のゲーム）を1回のstep()で進める。
+# 加速・ジャンプ・重力・床とブロックの当たり判定・ブロックの跳ね上がりは
+# Mario.update / Game.update と同じ規則を配列演算で行う（クリボーとキノコは扱わない）
+import random
+
+import numpy as np
+
+from main import (
+    ACTION_DASH,
+    ACTION_JUMP,
+    ACTION_LEFT,
+    ACTION_RIGHT,
+    BLOCK_BOUNCE_GRAVITY,
+    BLOCK_BOUNCE_SPEED,
+    GRAVITY,
+    JUMP_HOLD_POWER,
+    JUMP_HOLD_TIME,
+    JUMP_POWER,
+    MARIO_ACCEL,
+    MARIO_AIR_ACCEL,
+    MARIO_AIR_DECEL,
+    MARIO_DASH_MAX_SPEED,
+    MARIO_DEATH_DURATION,
+    MARIO_DEATH_GRAVITY,
+    MARIO_DEATH_JUMP_VY,
+    MARIO_DECEL,
+    MARIO_WALK_MAX_SPEED,
+    SCALE,
+    SCREEN_HEIGHT,
+    SCREEN_WIDTH,
+    SUBPIXEL_BITS,
+    SUBPIXEL_MASK,
+    SUBPIXELS,
+    TILE_SIZE_SCALED,
+    TILEMAP,
+)
+
+T = TILE_SIZE_SCALED
+FAR = 1 << 40  # 当たるものがない時の、掛からないほど遠い位置
+
+class BatchMario:
+    def __init__(self, n, pos=(SCREEN_WIDTH * SCALE // 2, 10 * TILE_SIZE_SCALED), size=(TILE_SIZE_SCALED, TILE_SIZE_SCALED), tilemap=TILEMAP):
+        self.n = n
+        self.pos = pos  # 出現位置（rect.midbottom）
+        self.w, self.h = size
+        self.rows = len(tilemap)
+        self.cols = len(tilemap[0])
+        self.map_pixel_width = self.cols * T
+
+        # 床（t==1）のセル
+        self.floor = np.array([[t == 1 for t in row] for row in tilemap], dtype=bool)
+        # ブロック（t==2,3）のセル -> ブロック番号（行優先順。Game.blocksと同じ並び）
+        self.block_id = np.full((self.rows, self.cols), -1, dtype=np.int32)
+        base_x = []
+        base_y = []
+        hatena = []
+        for y, row in enumerate(tilemap):
+            for x, t in enumerate(row):
+                if t in (2, 3):
+                    self.block_id[y, x] = len(base_x)
+                    base_x.append(x * T)
+                    base_y.append(y * T)
+                    hatena.append(t == 3)
+        self.block_x = np.array(base_x, dtype=np.int64)
+        self.block_base_y = np.array(base_y, dtype=np.int64)
+        self.block_hatena = np.array(hatena, dtype=bool)
+
+        # 跳ね上がり中のブロックが基準セルから上にはみ出す最大行数（CollisionGrid.block_reachと同じ）
+        height = 0.0
+        vy = BLOCK_BOUNCE_SPEED
+        while vy < 0:
+            height -= vy
+            vy += BLOCK_BOUNCE_GRAVITY
+        self.block_reach = -(-int(height) // T)
+
+        self.reset()
+
+    def reset(self):
+        n = self.n
+        nb = len(self.block_x)
+        self.x = np.full(n, self.pos[0] - self.w // 2, dtype=np.int64)  # rect.left
+        self.y = np.full(n, self.pos[1] - self.h, dtype=np.int64)  # rect.top
+        self.sub_x = np.zeros(n, dtype=np.int64)  # 位置の端数（Body.sub_x, sub_y）
+        self.sub_y = np.zeros(n, dtype=np.int64)
+        self.vx = np.zeros(n)
+        self.vy = np.zeros(n)
+        self.on_ground = np.zeros(n, dtype=bool)
+        self.facing_right = np.ones(n, dtype=bool)
+        self.jumping = np.zeros(n, dtype=bool)
+        self.jump_hold_count = np.zeros(n, dtype=np.int32)
+        self.dead = np.zeros(n, dtype=bool)
+        self.death_timer = np.zeros(n, dtype=np.int32)
+        self.done = np.zeros(n, dtype=bool)
+        # ブロックの状態（ゲームごと）
+        self.bounce_offset = np.zeros((n, nb))
+        self.bounce_vy = np.zeros((n, nb))
+        self.bouncing = np.zeros((n, nb), dtype=bool)
+        self.used = np.zeros((n, nb), dtype=bool)
+        self.block_y = np.broadcast_to(self.block_base_y, (n, nb)).copy()
+
+    def kill(self, mask):
+        # Mario.die()と同じ（クリボーに当たった場合などに外から呼ぶ）
+        mask = np.asarray(mask, dtype=bool) & ~self.dead
+        self.dead |= mask
+        self.death_timer[mask] = 0
+        self.vy[mask] = MARIO_DEATH_JUMP_VY
+        self.jumping[mask] = False
+        self.on_ground[mask] = False
+
+    def _cells(self, x, y, w, h, extra_rows=0):
+        # 矩形が掛かるセルを行優先順に並べた (K, N) の配列を返す
+        c0 = x // T
+        c1 = (x + w - 1) // T
+        r0 = y // T
+        r1 = (y + h - 1) // T + extra_rows
+        nr = int((r1 - r0).max()) + 1
+        nc = int((c1 - c0).max()) + 1
+        rows = r0 + np.repeat(np.arange(nr), nc)[:, None]
+        cols = c0 + np.tile(np.arange(nc), nr)[:, None]
+        valid = (rows <= r1) & (cols <= c1) & (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        return np.clip(rows, 0, self.rows - 1), np.clip(cols, 0, self.cols - 1), valid
+
+    def _block_candidates(self, idx, x, y, w, h):
+        # CollisionGrid.blocks_inと同じ順序の候補ブロックと、その現在の上端
+        rows, cols, valid = self._cells(x, y, w, h, self.block_reach)
+        bid = self.block_id[rows, cols]
+        valid &= bid >= 0
+        bid = np.where(valid, bid, 0)
+        by = self.block_y[idx, bid] if len(self.block_x) else np.zeros_like(bid)
+        bx = self.block_x[bid] if len(self.block_x) else np.zeros_like(bid)
+        return valid, bid, bx, by
+
+    def _sweep_x(self, idx, x, y, dx):
+        # CollisionGrid.sweep_xと同じ。dx（0なら動かない）のうち実際に動ける量を返す
+        w, h = self.w, self.h
+        left = x + np.minimum(dx, 0)
+        right = x + w + np.maximum(dx, 0)
+        rows, cols, valid = self._cells(left, y, right - left, h)
+        floor = valid & self.floor[rows, cols]
+        valid, _, bx, by = self._block_candidates(idx, left, y, right - left, h)
+        hit = valid & (bx < right) & (bx + T > left) & (by < y + h) & (by + T > y)
+        forward = np.minimum(np.where(floor, cols * T, FAR).min(axis=0), np.where(hit, bx, FAR).min(axis=0))
+        backward = np.maximum(np.where(floor, (cols + 1) * T, -FAR).max(axis=0), np.where(hit, bx + T, -FAR).max(axis=0))
+        return np.where(dx > 0, np.minimum(forward, right) - (x + w), np.where(dx < 0, np.maximum(backward, left) - x, 0))
+
+    def _sweep_y(self, idx, x, y, dy):
+        # CollisionGrid.sweep_yと同じ。(動ける量, 上に動いてブロックで止まったか) を返す
+        w, h = self.w, self.h
+        top = y + np.minimum(dy, 0)
+        bottom = y + h + np.maximum(dy, 0)
+        rows, cols, valid = self._cells(x, top, w, bottom - top)
+        floor = valid & self.floor[rows, cols]
+        valid, _, bx, by = self._block_candidates(idx, x, top, w, bottom - top)
+        hit = valid & (bx < x + w) & (bx + T > x) & (by < bottom) & (by + T > top)
+        down = np.minimum(np.where(floor, rows * T, FAR).min(axis=0), np.where(hit, by, FAR).min(axis=0))
+        up_tile = np.maximum(np.where(floor, (rows + 1) * T, -FAR).max(axis=0), top)
+        up_block = np.where(hit, by + T, -FAR).max(axis=0)
+        up = np.maximum(up_tile, up_block)
+        moved = np.where(dy > 0, np.minimum(down, bottom) - (y + h), np.where(dy < 0, up - y, 0))
+        return moved, (dy < 0) & (up_block > up_tile)
+
+    def step(self, actions):
+        # actionsはゲームごとのactionビット（長さNの配列）。Game.update 1回分に相当
+        actions = np.asarray(actions)
+        self.prev_y = self.y.copy()  # _head_hitsで使う、動く前の頭の位置
+        alive = np.flatnonzero(~self.dead)
+        if len(alive):
+            self._step_alive(alive, actions[alive])
+        dying = np.flatnonzero(self.dead)
+        if len(dying):
+            self._step_dead(dying)
+        self._head_hits()
+        self._update_blocks()
+        return self.done
+
+    def _step_alive(self, idx, actions):
+        x = self.x[idx]
+        y = self.y[idx]
+        vx = self.vx[idx]
+        vy = self.vy[idx]
+        on_ground = self.on_ground[idx]
+        jumping = self.jumping[idx]
+        hold = self.jump_hold_count[idx]
+        facing_right = self.facing_right[idx]
+
+        dash = (actions & ACTION_DASH) != 0
+        max_speed = np.where(dash, MARIO_DASH_MAX_SPEED, MARIO_WALK_MAX_SPEED)
+        accel = np.where(on_ground, MARIO_ACCEL, MARIO_AIR_ACCEL)
+        decel = np.where(on_ground, MARIO_DECEL, MARIO_AIR_DECEL)
+        move_left = (actions & ACTION_LEFT) != 0
+        move_right = (actions & ACTION_RIGHT) != 0
+        go_left = move_left & ~move_right
+        go_right = move_right & ~move_left
+        idle = ~(go_left | go_right)
+
+        vx = np.where(go_left & (vx > -max_speed), np.maximum(vx - accel, -max_speed), vx)
+        vx = np.where(go_right & (vx < max_speed), np.minimum(vx + accel, max_speed), vx)
+        vx = np.where(idle & (vx > 0), np.maximum(vx - decel, 0.0), vx)
+        vx = np.where(idle & (vx < 0), np.minimum(vx + decel, 0.0), vx)
+        facing_right = np.where(go_left, False, np.where(go_right, True, facing_right))
+
+        # ジャンプ処理
+        jump = (actions & ACTION_JUMP) != 0
+        start = jump & on_ground & ~jumping
+        holding = jump & ~start & jumping & (hold < JUMP_HOLD_TIME)
+        vy = np.where(start, -JUMP_POWER, np.where(holding, vy - JUMP_HOLD_POWER, vy))
+        hold = np.where(start, 0, np.where(holding, hold + 1, hold))
+        jumping = np.where(start, True, jumping & jump)
+        on_ground = on_ground & ~start
+
+        # 横移動（Body.move_xと同じく端数付きで進め、当たったらその手前で止める）
+        position = (x << SUBPIXEL_BITS) + self.sub_x[idx] + np.trunc(vx * SUBPIXELS).astype(np.int64)
+        dx = (position >> SUBPIXEL_BITS) - x
+        moved = self._sweep_x(idx, x, y, dx)
+        hit = moved != dx
+        x = x + moved
+        sub_x = np.where(hit, 0, position & SUBPIXEL_MASK)
+        vx = np.where(hit, 0.0, vx)
+
+        # 重力と縦移動
+        vy = vy + GRAVITY
+        position = (y << SUBPIXEL_BITS) + self.sub_y[idx] + np.trunc(vy * SUBPIXELS).astype(np.int64)
+        dy = (position >> SUBPIXEL_BITS) - y
+        moved, hit_block = self._sweep_y(idx, x, y, dy)
+        hit = moved != dy
+        y = y + moved
+        sub_y = np.where(hit, 0, position & SUBPIXEL_MASK)
+        land = hit & (dy > 0)
+        # ブロックに下から当たった時はvyを残す（_head_hitsで跳ね上げ判定に使う）
+        vy = np.where(land | (hit & (dy < 0) & ~hit_block), 0.0, vy)
+        on_ground = land
+        jumping &= ~land
+        hold = np.where(land, 0, hold)
+
+        # マップ外に出ないように
+        left_out = x < 0
+        x = np.where(left_out, 0, x)
+        right_out = x + self.w > self.map_pixel_width
+        x = np.where(right_out, self.map_pixel_width - self.w, x)
+        vx = np.where(left_out | right_out, 0.0, vx)
+        sub_x = np.where(left_out | right_out, 0, sub_x)
+
+        self.x[idx] = x
+        self.y[idx] = y
+        self.sub_x[idx] = sub_x
+        self.sub_y[idx] = sub_y
+        self.vx[idx] = vx
+        self.vy[idx] = vy
+        self.on_ground[idx] = on_ground
+        self.jumping[idx] = jumping
+        self.jump_hold_count[idx] = hold
+        self.facing_right[idx] = facing_right
+
+    def _step_dead(self, idx):
+        # 死亡時
+        self.vx[idx] = 0.0
+        vy = self.vy[idx] + MARIO_DEATH_GRAVITY
+        self.vy[idx] = vy
+        self.y[idx] += np.trunc(vy).astype(np.int64)
+        self.death_timer[idx] += 1
+        self.done[idx] |= (self.death_timer[idx] > MARIO_DEATH_DURATION) | (self.y[idx] > SCREEN_HEIGHT * SCALE)
+
+    def _head_hits(self):
+        # マリオがブロックを下から叩いたか判定（Game.updateと同じ条件）
+        idx = np.flatnonzero((self.vy < 0) & (self.y <= self.prev_y))
+        if not len(idx) or not len(self.block_x):
+            return
+        x = self.x[idx]
+        top = self.y[idx]
+        prev_top = self.prev_y[idx]
+        valid, bid, bx, by = self._block_candidates(idx, x, top - 1, self.w, prev_top - top + 2)
+        bottom = by + T
+        hit = valid & (prev_top >= bottom) & (top <= bottom) & (x + self.w > bx) & (x < bx + T)
+        k = hit.argmax(axis=0)
+        i = np.arange(len(idx))
+        found = hit[k, i]
+        games = idx[found]
+        hit_id = bid[k, i][found]
+        # Block.hit_from_below: パネルになったはてなブロックは跳ね上がらない
+        can_bounce = ~(self.block_hatena[hit_id] & self.used[games, hit_id]) & ~self.bouncing[games, hit_id]
+        g = games[can_bounce]
+        b = hit_id[can_bounce]
+        self.bouncing[g, b] = True
+        self.bounce_vy[g, b] = BLOCK_BOUNCE_SPEED
+        self.used[g, b] |= self.block_hatena[b]
+        self.vy[games] = 0.0
+
+    def _update_blocks(self):
+        # Block.updateと同じ跳ね上がり
+        b = self.bouncing
+        if not b.any():
+            return
+        self.bounce_offset = np.where(b, self.bounce_offset + self.bounce_vy, self.bounce_offset)
+        self.bounce_vy = np.where(b, self.bounce_vy + BLOCK_BOUNCE_GRAVITY, self.bounce_vy)
+        landed = b & (self.bounce_offset >= 0)
+        self.bounce_offset[landed] = 0.0
+        self.bounce_vy[landed] = 0.0
+        self.bouncing &= ~landed
+        self.block_y = self.block_base_y + np.round(self.bounce_offset).astype(np.int64)
+
+def verify_against_scalar(n=8, frames=900, seed=0):
+    # Gameのマリオと1フレームずつ比較する（クリボーは消しておく）。食い違いがあればAssertionError
+    from main import Game
+    rng = random.Random(seed)
+    choices = [0, ACTION_RIGHT, ACTION_RIGHT | ACTION_DASH, ACTION_RIGHT | ACTION_JUMP, ACTION_LEFT,
+               ACTION_LEFT | ACTION_JUMP, ACTION_JUMP, ACTION_RIGHT | ACTION_DASH | ACTION_JUMP, ACTION_LEFT | ACTION_DASH]
+    scripts = []
+    for _ in range(n):
+        script = []
+        while len(script) < frames:
+            script += [rng.choice(choices)] * rng.randint(3, 40)
+        scripts.append(script)
+    kill_frame = [rng.randint(frames // 2, frames) for _ in range(n)]
+
+    games = []
+    for _ in range(n):
+        game = Game()
+        game.kuribos.clear()
+        game.sleeping_kuribos.clear()
+        games.append(game)
+    batch = BatchMario(n)
+    actions = np.zeros(n, dtype=np.uint8)
+    for frame in range(frames):
+        for i in range(n):
+            actions[i] = scripts[i][frame]
+            if frame == kill_frame[i]:
+                games[i].mario.die()
+        batch.kill(np.array(kill_frame) == frame)
+        for game, action in zip(games, actions):
+            game.step(int(action))
+        batch.step(actions)
+        for i, game in enumerate(games):
+            mario = game.mario
+            expected = (mario.rect.x, mario.rect.y, mario.sub_x, mario.sub_y, mario.vx, mario.vy, mario.on_ground, mario.jumping,
+                        mario.jump_hold_count, mario.dead)
+            actual = (batch.x[i], batch.y[i], batch.sub_x[i], batch.sub_y[i], batch.vx[i], batch.vy[i], batch.on_ground[i],
+                      batch.jumping[i], batch.jump_hold_count[i], batch.dead[i])
+            assert expected == actual, "frame %d game %d: scalar %r != batch %r" % (frame, i, expected, actual)
+            # Gameのブロックは近くの列だけ作られるので、基準位置で対応を取る
+            for block in game.blocks:
+                b = batch.block_id[block.base_y // T, block.base_x // T]
+                assert block.rect.y == batch.block_y[i, b], "frame %d game %d: block at %r y %d != %d" % (frame, i, (block.base_x, block.base_y), block.rect.y, batch.block_y[i, b])
+
+if __name__ == "__main__":
+    import time
+    verify_against_scalar()
+    print("parity OK")
+    for n in (1, 100, 1000, 10000):
+        batch = BatchMario(n)
+        actions = np.random.default_rng(0).integers(0, 16, size=n, dtype=np.uint8)
+        steps = 300
+        start = time.perf_counter()
+        for _ in range(steps):
+            batch.step(actions)
+        elapsed = time.perf_counter() - start
+        print("N=%5d: %10.0f mario-steps/s" % (n, n * steps / elapsed))
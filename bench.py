@@ -0,0 +1,301 @@
+# --- ベンチマーク ---
+# 決まった入力・決まったレベルのシナリオをウィンドウなしで回し、
+# シミュレーション（Game.step）と描画（Game.render）のtick/秒、メモリのピークを測る。
+# シナリオを途中まで進めてからのGame.reset()の時間（リセットの遅延）も測る。
+# 温まった後のフレームで、1フレームの間に一時的に確保したメモリ（tracemallocのピーク）とGCの回数も測り、
+# 予算（ALLOC_FRAME_BUDGET / ALLOC_GC_BUDGET）を超えたシナリオがあれば失敗にする。
+# 保存してあるベースライン（JSON）と比べて、遅くなった・メモリが増えたシナリオがあれば終了コード1で終わる
+#
+#   python bench.py                      : 全シナリオを測ってbench_baseline.jsonと比べる
+#   python bench.py idle dash            : 指定したシナリオだけ
+#   python bench.py --save-baseline      : 測った結果をベースラインとして保存する
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame
+
+from level_format import generate_level
+from main import (
+    ACTION_DASH, ACTION_JUMP, ACTION_RIGHT, ASSET_CACHE_PATH, SCALE, SCREEN_HEIGHT, SCREEN_WIDTH, TILE_SIZE_SCALED, TILEMAP,
+    ActionKeys, Game, Level, load_assets,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+DEFAULT_TOLERANCE = 0.25  # ベースラインからこの割合を超えて悪くなったら失敗
+RESET_SAMPLES = 50  # リセットの遅延を測る回数
+RESET_TICKS = 60  # リセットの前に進めるtick数（キノコやクリボー、叩いたブロックがある状態からリセットする）
+ALLOC_WARMUP = 300  # メモリの確保を測る前に進めるtick数（プールやブロックの列、画面のチャンクを温める）
+ALLOC_TICKS = 600  # メモリの確保を測るtick数
+# 1フレーム（Game.update + Game.render）の間に一時的に確保してよいバイト数。
+# Pythonでは256を超える整数やpygameのRectを作るだけで確保が起きるので0にはできない。
+# 今は1〜6KiB程度なので、毎フレームリストやジェネレータを作り直すような変更が入ったら気付ける大きさにしておく
+ALLOC_FRAME_BUDGET = 16 * 1024
+ALLOC_GC_BUDGET = 0  # 測っている間に起きてよいGCの回数
+# 予算を当てはめないシナリオ（300匹が重なり合うと接触の組とイベントのタプルが毎フレーム数万個できる）
+ALLOC_EXEMPT = {'kuribos'}
+
+# --- シナリオ用のレベル ---
+def hatena_level(cols):
+    # 床の上の10行目に、はてなブロックを1列おきに並べたレベル（走りながら跳ぶとキノコがたくさん出る）
+    rows = len(TILEMAP)
+    data = bytearray(rows * cols)
+    for col in range(cols):
+        base = col * rows
+        data[base + rows - 2] = 1
+        data[base + rows - 1] = 1
+        if col >= 10 and col % 2 == 0:
+            data[base + 10] = 3
+    return Level(rows, cols, bytes(data))
+
+def kuribo_level(cols, count):
+    # 10列目から右に、count匹のクリボーの出現位置を1〜12行目に詰めて並べたレベル
+    rows = len(TILEMAP)
+    data = bytearray(rows * cols)
+    for col in range(cols):
+        data[col * rows + rows - 2] = 1
+        data[col * rows + rows - 1] = 1
+    spawn_rows = rows - 3
+    for i in range(count):
+        col = 10 + i // spawn_rows
+        row = 1 + i % spawn_rows
+        data[col * rows + row] = 4
+    return Level(rows, cols, bytes(data))
+
+# --- シナリオ用の入力（tickの番号からactionを決める） ---
+def idle_input(tick):
+    return 0
+
+def dash_input(tick):
+    # 右にダッシュし続け、50tickごとに20tickジャンプボタンを押す（ブロックを越えるため）
+    action = ACTION_RIGHT | ACTION_DASH
+    if tick % 50 < 20:
+        action |= ACTION_JUMP
+    return action
+
+def hit_input(tick):
+    # 右に歩きながらジャンプを繰り返して、頭上のはてなブロックを叩いていく
+    action = ACTION_RIGHT
+    if tick % 40 < 12:
+        action |= ACTION_JUMP
+    return action
+
+# 名前 -> (説明, レベルを作る関数（Noneなら組み込みのTILEMAP）, 入力, tick数, Gameの引数)
+SCENARIOS = {
+    'idle': ("立ち止まったまま", None, idle_input, 3000, {}),
+    'dash': ("マップの端までダッシュ", None, dash_input, 3000, {}),
+    'mushrooms': ("はてなブロックを叩き続けてキノコを出す", lambda: hatena_level(400), hit_input, 3000, {}),
+    # 全員を動かすため、動かす範囲をマップ全体にする
+    'kuribos': ("300匹のクリボー", lambda: kuribo_level(64, 300), idle_input, 1500, {'active_margin': 64 * TILE_SIZE_SCALED}),
+    'wide': ("100000列のレベルをダッシュ", lambda: generate_level(100000, 1), dash_input, 6000, {}),
+}
+
+def time_scenario(game, surface, script, ticks):
+    # (シミュレーションの秒数, 描画の秒数, リセットの回数)
+    sim_time = 0.0
+    render_time = 0.0
+    resets = 0
+    perf_counter = time.perf_counter
+    for tick in range(ticks):
+        action = script(tick)
+        start = perf_counter()
+        _, _, done, _ = game.step(action)
+        if done:
+            game.reset()
+            resets += 1
+        middle = perf_counter()
+        game.render(surface)
+        render_time += perf_counter() - middle
+        sim_time += middle - start
+    return sim_time, render_time, resets
+
+def time_resets(game, script, samples=RESET_SAMPLES, ticks=RESET_TICKS):
+    # シナリオをticksだけ進めてからreset()するのを繰り返し、reset()の時間の (p50, p99)（マイクロ秒）を返す
+    perf_counter = time.perf_counter
+    latencies = []
+    for _ in range(samples):
+        for tick in range(ticks):
+            game.step(script(tick))
+        start = perf_counter()
+        game.reset()
+        latencies.append(perf_counter() - start)
+    latencies.sort()
+    last = len(latencies) - 1
+    return latencies[last * 50 // 100] * 1e6, latencies[last * 99 // 100] * 1e6
+
+def measure_allocations(game, surface, script, warmup=ALLOC_WARMUP, ticks=ALLOC_TICKS):
+    # warmup tick進めてから、ticksの間の (1フレームで一時的に確保した最大バイト数, 増えたバイト数, GCの回数) を返す
+    keys = ActionKeys()
+    for tick in range(warmup):
+        keys.action = script(tick)
+        game.update(keys)
+        game.render(surface)
+    collections = [0]
+
+    def count_collections(phase, info):
+        if phase == "start":
+            collections[0] += 1
+
+    worst = 0
+    gc.callbacks.append(count_collections)
+    tracemalloc.start()
+    try:
+        start, _ = tracemalloc.get_traced_memory()
+        for tick in range(warmup, warmup + ticks):
+            keys.action = script(tick)
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            game.update(keys)
+            game.render(surface)
+            _, peak = tracemalloc.get_traced_memory()
+            worst = max(worst, peak - before)
+        end, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        gc.callbacks.remove(count_collections)
+    return worst, end - start, collections[0]
+
+def run_scenario(name, atlas, ticks=None, repeat=3):
+    # 時間はrepeat回測って一番速かった回を使い（ほかのプロセスの影響を減らす）、
+    # もう1回tracemallocを有効にして回してPythonのメモリのピークを測る。結果の辞書を返す
+    _, make_level, script, default_ticks, options = SCENARIOS[name]
+    ticks = ticks or default_ticks
+    level = make_level() if make_level is not None else None
+    surface = pygame.Surface((SCREEN_WIDTH * SCALE, SCREEN_HEIGHT * SCALE))
+
+    sim_time = render_time = float("inf")
+    for _ in range(repeat):
+        sim, render, resets = time_scenario(Game(atlas, level, **options), surface, script, ticks)
+        sim_time = min(sim_time, sim)
+        render_time = min(render_time, render)
+    reset_p50, reset_p99 = time_resets(Game(atlas, level, **options), script)
+
+    game = Game(atlas, level, **options)
+    tracemalloc.start()
+    for tick in range(ticks):
+        _, _, done, _ = game.step(script(tick))
+        if done:
+            game.reset()
+        game.render(surface)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    frame_alloc, alloc_growth, collections = measure_allocations(Game(atlas, level, **options), surface, script)
+
+    return {
+        'ticks': ticks,
+        'sim_tps': ticks / sim_time,
+        'render_tps': ticks / render_time,
+        'peak_kib': peak / 1024,
+        'resets': resets,
+        'reset_us': reset_p50,
+        'reset_p99_us': reset_p99,
+        'frame_alloc_bytes': frame_alloc,
+        'alloc_growth_bytes': alloc_growth,
+        'gc_collections': collections,
+    }
+
+def max_rss_kib():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+def check_allocations(results):
+    # 1フレームの確保やGCの回数が予算を超えたシナリオの説明のリストを返す
+    failures = []
+    for name, result in results.items():
+        if name in ALLOC_EXEMPT:
+            continue
+        if result['frame_alloc_bytes'] > ALLOC_FRAME_BUDGET:
+            failures.append("%s: frame_alloc_bytes %d > budget %d" % (name, result['frame_alloc_bytes'], ALLOC_FRAME_BUDGET))
+        if result['gc_collections'] > ALLOC_GC_BUDGET:
+            failures.append("%s: gc_collections %d > budget %d" % (name, result['gc_collections'], ALLOC_GC_BUDGET))
+    return failures
+
+def compare(results, baseline, tolerance):
+    # ベースラインより悪くなった項目の説明のリストを返す
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for key in ('sim_tps', 'render_tps'):
+            if result[key] < base[key] * (1 - tolerance):
+                failures.append("%s: %s %.0f < baseline %.0f" % (name, key, result[key], base[key]))
+        if result['peak_kib'] > base['peak_kib'] * (1 + tolerance) + 64:
+            failures.append("%s: peak_kib %.0f > baseline %.0f" % (name, result['peak_kib'], base['peak_kib']))
+        # リセットは数十マイクロ秒なので、時計の揺れの分として50µsまでは許す
+        if 'reset_us' in base and result['reset_us'] > base['reset_us'] * (1 + tolerance) + 50:
+            failures.append("%s: reset_us %.0f > baseline %.0f" % (name, result['reset_us'], base['reset_us']))
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description="シナリオごとの速度とメモリを測る")
+    parser.add_argument("scenarios", nargs="*", help="測るシナリオ（省略時はすべて: %s）" % ", ".join(SCENARIOS))
+    parser.add_argument("--ticks", type=int, help="シナリオのtick数を変える")
+    parser.add_argument("--repeat", type=int, default=3, help="時間を測る回数（一番速かった回を使う）")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="比べるベースラインのJSON")
+    parser.add_argument("--save-baseline", action="store_true", help="結果をベースラインとして保存する")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="許す悪化の割合")
+    parser.add_argument("--json", metavar="FILE", help="結果をJSONで書き出す")
+    args = parser.parse_args()
+
+    names = args.scenarios or list(SCENARIOS)
+    for name in names:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario: %s" % name)
+
+    atlas = load_assets(convert=False, cache_path=ASSET_CACHE_PATH)
+    results = {}
+    print("%-10s %8s %12s %12s %10s %16s %12s %4s" % ("scenario", "ticks", "sim tick/s", "render tick/s", "peak KiB",
+                                                       "reset us p50/p99", "frame alloc", "gc"))
+    for name in names:
+        result = run_scenario(name, atlas, args.ticks, args.repeat)
+        results[name] = result
+        print("%-10s %8d %12.0f %12.0f %10.0f %8.1f/%7.1f %12d %4d" % (
+            name, result['ticks'], result['sim_tps'], result['render_tps'], result['peak_kib'], result['reset_us'],
+            result['reset_p99_us'], result['frame_alloc_bytes'], result['gc_collections']))
+    print("max RSS: %d KiB" % max_rss_kib())
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    alloc_failures = check_allocations(results)
+    for failure in alloc_failures:
+        print("OVER BUDGET %s" % failure)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("saved baseline: %s" % args.baseline)
+        return 1 if alloc_failures else 0
+
+    if not os.path.exists(args.baseline):
+        print("no baseline (%s); run with --save-baseline" % args.baseline)
+        return 1 if alloc_failures else 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    failures = compare(results, baseline, args.tolerance)
+    for failure in failures:
+        print("REGRESSION %s" % failure)
+    if not failures:
+        print("no regressions (tolerance %.0f%%)" % (args.tolerance * 100))
+    return 1 if failures or alloc_failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
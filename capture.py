@@ -0,0 +1,115 @@
+# --- 画面の録画（書き出しは別スレッド） ---
+# capture()は描き終えた画面を、あらかじめ作っておいた同じ形式のSurfaceの1枚にblitするだけで戻る。
+# 変換とファイルへの書き出しはワーカースレッドが行い、書き終えたSurfaceを空きに戻す。
+# 空きのSurfaceがない時（書き出しが追いつかない時）はそのフレームを捨てる（ゲームのループは待たせない）
+#
+# format:
+#   'raw' : RGB24の画素をヘッダなしで1つのファイルに続けて書く（ffmpegなら -f rawvideo -pix_fmt rgb24 -s 幅x高さ で読める）
+#   'png' : pathのディレクトリにframe_000000.png からの連番で書く
+import os
+import queue
+import threading
+import time
+
+import pygame
+
+FORMATS = ('raw', 'png')
+
+class FrameCapture:
+    def __init__(self, screen, path, format='raw', pool_size=8):
+        if format not in FORMATS:
+            raise ValueError("unknown capture format: %r" % (format,))
+        self.path = path
+        self.format = format
+        self.size = screen.get_size()
+        # screenと同じ形式なので、blitは画素のコピーだけで済む
+        self._free = queue.SimpleQueue()
+        for _ in range(pool_size):
+            self._free.put(screen.copy())
+        self._ready = queue.SimpleQueue()  # (フレーム番号, Surface)。Noneで終わり
+        self.frames = 0  # capture()を呼んだ回数
+        self.dropped = 0  # 空きがなくて捨てたフレーム数
+        self.written = 0  # 書き出したフレーム数
+        self.capture_time = 0.0  # capture()に掛かった時間の合計（秒）
+        self.write_time = 0.0  # ワーカーが変換と書き出しに掛けた時間の合計（秒）
+        if format == 'png':
+            os.makedirs(path, exist_ok=True)
+            self._file = None
+        else:
+            self._file = open(path, "wb")
+            # ワーカーでRGBの順（赤が先頭のバイト）の24bitに変換する先。画素をそのままファイルに書く
+            self._rgb = pygame.Surface(self.size, 0, 24, (0xFF, 0xFF00, 0xFF0000, 0))
+        self._thread = threading.Thread(target=self._run, name="FrameCapture", daemon=True)
+        self._thread.start()
+
+    def capture(self, screen):
+        # screenの今の画面を書き出しに回す。空きがなければ捨ててFalseを返す
+        start = time.perf_counter()
+        frame = self.frames
+        self.frames += 1
+        try:
+            surface = self._free.get_nowait()
+        except queue.Empty:
+            self.dropped += 1
+            self.capture_time += time.perf_counter() - start
+            return False
+        surface.blit(screen, (0, 0))
+        self._ready.put((frame, surface))
+        self.capture_time += time.perf_counter() - start
+        return True
+
+    def _run(self):
+        perf_counter = time.perf_counter
+        while True:
+            item = self._ready.get()
+            if item is None:
+                break
+            frame, surface = item
+            start = perf_counter()
+            if self._file is not None:
+                # 変換したSurfaceの画素を直接書く（bytesを作らない。書いている間はSurfaceがロックされる）
+                rgb = self._rgb
+                rgb.blit(surface, (0, 0))
+                buffer = rgb.get_buffer()
+                self._file.write(buffer)
+                del buffer
+            else:
+                pygame.image.save(surface, os.path.join(self.path, "frame_%06d.png" % frame))
+            self.write_time += perf_counter() - start
+            self.written += 1
+            self._free.put(surface)
+
+    def close(self):
+        # 残っているフレームを書き終えるまで待ってファイルを閉じる
+        if self._thread is None:
+            return
+        self._ready.put(None)
+        self._thread.join()
+        self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self):
+        # {'frames', 'written', 'dropped', 'drop_rate', 'capture_us', 'write_us'}
+        # capture_usはゲームのループ側の1フレームあたりの時間、write_usはワーカーの1フレームあたりの時間
+        return {
+            'frames': self.frames,
+            'written': self.written,
+            'dropped': self.dropped,
+            'drop_rate': self.dropped / self.frames if self.frames else 0.0,
+            'capture_us': self.capture_time / self.frames * 1e6 if self.frames else 0.0,
+            'write_us': self.write_time / self.written * 1e6 if self.written else 0.0,
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return "%s: %d frames (%dx%d %s), dropped %d (%.1f%%), capture %.1f us/frame, write %.1f us/frame" % (
+            self.path, stats['written'], self.size[0], self.size[1], self.format, stats['dropped'],
+            stats['drop_rate'] * 100, stats['capture_us'], stats['write_us'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,103 @@
+# --- 差分描画（変わったところだけを描き直す） ---
+# 前のフレームの画面をそのまま残しておき、
+#   - カメラが動いた分だけ画面をずらして（Surface.scroll）、新しく見えた列だけを描く
+#   - 動いた・絵が変わったスプライト（跳ね上がり中や叩かれたブロックも）の前と今の矩形だけを描き直す
+# 描き直した矩形のリストを返すので、pygame.display.update(rects)で画面に出す
+# （カメラが動いたフレームは画面全体がずれるので、画面全体の矩形を返す）
+#
+# 補間描画（Game.renderのalpha）には対応しない。screenにほかのものを描いた時はinvalidate()を呼ぶこと
+import pygame
+
+from main import SCREEN_HEIGHT, SCREEN_WIDTH, SCALE
+
+class DirtyRenderer:
+    def __init__(self, game):
+        self.game = game
+        self.view = pygame.Rect(0, 0, SCREEN_WIDTH * SCALE, SCREEN_HEIGHT * SCALE)
+        self._camera_x = None  # 前のフレームのカメラ位置（Noneなら次は全体を描く）
+        self._drawn = {}  # 前のフレームに描いたもの -> (image, x, y)（xはマップ上の座標）
+        self._invalid = []  # 次のフレームで描き直す矩形（画面上の座標）
+
+    def invalidate(self, rect=None):
+        # 次のフレームでrect（省略時は画面全体）を描き直す
+        if rect is None:
+            self._camera_x = None
+        else:
+            self._invalid.append(pygame.Rect(rect))
+
+    def render(self, screen):
+        # screenを今の状態に更新して、変わった矩形のリストを返す
+        game = self.game
+        camera_x = game.camera_x
+        view = self.view
+        view_width = view.width
+        drawn = {}
+        sprites = []
+        for obj in game.visible_sprites(camera_x, camera_x + view_width):
+            image = obj.image
+            x = obj.rect.x
+            y = obj.rect.y
+            drawn[obj] = (image, x, y)
+            sprites.append((obj, image, x, y))
+        previous = self._drawn
+        self._drawn = drawn
+
+        prev_camera_x = self._camera_x
+        self._camera_x = camera_x
+        if prev_camera_x is None or abs(camera_x - prev_camera_x) >= view_width:
+            # 最初のフレームや大きく飛んだ時は全体を描く
+            self._invalid.clear()
+            game.static_layer.draw(screen, camera_x)
+            for obj, image, x, y in sprites:
+                screen.blit(image, (x - camera_x, y))
+            return [view]
+
+        dirty = self._invalid
+        self._invalid = []
+        dx = camera_x - prev_camera_x
+        if dx:
+            # 前のフレームをずらして、新しく見えた列を描き直す
+            screen.scroll(-dx, 0)
+            # invalidate()された矩形の中身も一緒にずれているので、ずれた先も描き直す
+            dirty += [rect.move(-dx, 0) for rect in dirty]
+            if dx > 0:
+                dirty.append(pygame.Rect(view_width - dx, 0, dx, view.height))
+            else:
+                dirty.append(pygame.Rect(0, 0, -dx, view.height))
+
+        # 動いたか絵が変わったものの、前の矩形と今の矩形
+        for obj, image, x, y in sprites:
+            old = previous.pop(obj, None)
+            if old is not None and old[0] is image and old[1] == x and old[2] == y:
+                continue
+            dirty.append(image.get_rect(topleft=(x - camera_x, y)))
+            if old is not None:
+                dirty.append(old[0].get_rect(topleft=(old[1] - camera_x, old[2])))
+        # 前のフレームにあって、今は描かないもの（画面の外に出た・消えた）
+        for image, x, y in previous.values():
+            dirty.append(image.get_rect(topleft=(x - camera_x, y)))
+
+        # 重なっている矩形はまとめ、画面に掛かる部分だけを描き直す
+        regions = []
+        for rect in dirty:
+            rect = rect.clip(view)
+            if not rect.width or not rect.height:
+                continue
+            index = rect.collidelist(regions)
+            while index != -1:
+                rect.union_ip(regions.pop(index))
+                index = rect.collidelist(regions)
+            regions.append(rect)
+        for region in regions:
+            screen.set_clip(region)
+            game.static_layer.draw(screen, camera_x)
+            left = region.left + camera_x
+            right = region.right + camera_x
+            for obj, image, x, y in sprites:
+                if x < right and x + image.get_width() > left and y < region.bottom and y + image.get_height() > region.top:
+                    screen.blit(image, (x - camera_x, y))
+        screen.set_clip(None)
+
+        if dx:
+            return [view]
+        return regions
@@ -0,0 +1,68 @@
+# --- レベルファイル（列優先のタイルコード、メモリマップで読む） ---
+# タイルコード（uint8）を列ごとに並べて書き出し、読むときはファイルをメモリマップする。
+# ゲームはカメラとキャラの周りの列しか触らないので、そのページだけが読み込まれる
+# （何万列のレベルでも使うメモリはほぼ一定。同じファイルを開いた複数のプロセスでページを共有できる）
+#
+# ファイル形式（整数はlittle endian）:
+#   ヘッダ: MAGIC(4バイト), バージョン(uint8), 行数(uint16), 列数(uint32)
+#   タイル: data[col * rows + row] を列数 x 行数バイト
+import mmap
+import random
+import struct
+import sys
+
+from main import TILEMAP, Level
+
+MAGIC = b"MLVL"
+VERSION = 1
+HEADER = struct.Struct("<4sBHI")
+
+def save_level(path, level):
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, level.rows, level.cols))
+        f.write(level.data)
+
+def load_level(path):
+    # Levelのdataはmmapを直接参照する（Levelを使っている間はファイルを開いたままにする）
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, rows, cols = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or version != VERSION:
+        buf.close()
+        raise ValueError("not a level file")
+    if len(buf) < HEADER.size + rows * cols:
+        buf.close()
+        raise ValueError("level file is truncated")
+    return Level(rows, cols, memoryview(buf)[HEADER.size:HEADER.size + rows * cols])
+
+def generate_level(cols, seed=0):
+    # 動作確認・ベンチマーク用の長いレベル（床は下の2行、穴はなし。TILEMAPと同じ高さ）
+    rng = random.Random(seed)
+    rows = len(TILEMAP)
+    data = bytearray(rows * cols)
+    for col in range(cols):
+        base = col * rows
+        data[base + rows - 2] = 1
+        data[base + rows - 1] = 1
+        if col < 4:
+            continue  # スタート地点の周りは空けておく
+        r = rng.random()
+        if r < 0.08:
+            data[base + 10] = 2
+        elif r < 0.12:
+            data[base + 10] = 3
+        elif r < 0.14:
+            data[base + 12] = 2
+        elif r < 0.17:
+            data[base + 12] = 4  # クリボー
+    return Level(rows, cols, bytes(data))
+
+if __name__ == "__main__":
+    # python level_format.py 出力ファイル 列数 [seed] : レベルを生成して書き出す
+    if len(sys.argv) < 3:
+        print("usage: python level_format.py OUTPUT COLUMNS [SEED]")
+        sys.exit(1)
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+    level = generate_level(int(sys.argv[2]), seed)
+    save_level(sys.argv[1], level)
+    print("%s: %d x %d tiles" % (sys.argv[1], level.cols, level.rows))
@@ -1,15 +1,19 @@
 import pygame
 
 class Block:
+    # snapshot用の状態: rect.y, bounce_offset, bouncing, bounce_vy, used, _mushroom_spawned
+    STATE_FORMAT = "id?d??"
+
     def __init__(self, image, x, y, block_type="normal", alt_image=None, spawn_callback=None):
         self.image = image
+        self.default_image = image
         self.rect = self.image.get_rect(topleft=(x, y))
         self.base_x = x
         self.base_y = y
         self.bounce_offset = 0.0
         self.bouncing = False
-        self.bounce_speed = -8.0  # 跳ね上がる初速（大きくして目立つように）
-        self.bounce_gravity = 1.0  # 跳ね上がる重力（大きくして戻りやすく）
+        self.bounce_speed = BLOCK_BOUNCE_SPEED  # 跳ね上がる初速（大きくして目立つように）
+        self.bounce_gravity = BLOCK_BOUNCE_GRAVITY  # 跳ね上がる重力（大きくして戻りやすく）
         self.bounce_vy = 0.0
         self.block_type = block_type  # normal or hatena
         self.alt_image = alt_image  # 画像切り替え用（パネル画像）
@@ -51,14 +55,34 @@ class Block:
         else:
             self.rect.y = self.base_y
 
-    def draw(self, surface, camera_x):
-        # camera_x分だけ左にずらして描画
-        draw_rect = self.rect.copy()
-        draw_rect.x -= camera_x
-        surface.blit(self.image, draw_rect)
+    def get_state(self):
+        return (self.rect.y, self.bounce_offset, self.bouncing, self.bounce_vy, self.used, self._mushroom_spawned)
+
+    def set_state(self, state):
+        self.rect.y, self.bounce_offset, self.bouncing, self.bounce_vy, self.used, self._mushroom_spawned = state
+        self.image = self.alt_image if self.used and self.alt_image else self.default_image
+
+    def reset_state(self):
+        self.set_state((self.base_y, 0.0, False, 0.0, False, False))
 
+import argparse
+import re
+import struct
 import sys
 import os
+import time
+import weakref
+
+import asset_cache
+from profiler import (
+    PHASE_BLOCK_HITS, PHASE_BLOCKS, PHASE_CONTACTS, PHASE_ENTITIES, PHASE_FLIP, PHASE_INPUT, PHASE_MARIO,
+    PHASE_SPRITES, PHASE_TILES, PHASE_WORLD,
+)
+
+# 画像フォルダ（どこから起動しても見つかるようにこのファイル基準）
+IMAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "images")
+# スケール済みスプライトのキャッシュファイル（元画像かSCALEが変わると自動で作り直す）
+ASSET_CACHE_PATH = os.path.join(IMAGE_DIR, "sprites.cache")
 
 # タイルサイズ
 TILE_SIZE = 16
@@ -80,16 +104,29 @@ MARIO_AIR_DECEL = 0.10 * SCALE
 JUMP_POWER = 5.2 * SCALE
 GRAVITY = 0.5 * SCALE
 JUMP_HOLD_TIME = 12
+JUMP_HOLD_POWER = 0.35 * SCALE
+
+# マリオ死亡時のパラメータ
+MARIO_DEATH_JUMP_VY = -8.0 * SCALE
+MARIO_DEATH_GRAVITY = 0.35 * SCALE
+MARIO_DEATH_DURATION = 120
 
 # クリボーのパラメータ
 KURIBO_WALK_SPEED = 1.0 * SCALE
 KURIBO_GRAVITY = GRAVITY
 
-def load_and_scale(path):
-    img = pygame.image.load(path).convert_alpha()
+# ブロックの跳ね上がりパラメータ
+BLOCK_BOUNCE_SPEED = -8.0
+BLOCK_BOUNCE_GRAVITY = 1.0
+
+def load_and_scale(path, convert=True):
+    img = pygame.image.load(path)
+    if convert:
+        # convert_alpha()はウィンドウ（ディスプレイ）がないと使えない
+        img = img.convert_alpha()
     return pygame.transform.scale(img, (img.get_width() * SCALE, img.get_height() * SCALE))
 
-# タイルマップ（0:空, 1:床, 2:ブロック, 3:はてなブロック）
+# タイルマップ（0:空, 1:床, 2:ブロック, 3:はてなブロック, 4:クリボーの出現位置）
 # 横スクロール用に横幅を拡張
 TILEMAP = [
     [0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0],
@@ -122,38 +159,360 @@ TILEMAP[10][20] = 2
 TILEMAP[10][25] = 3  # 新しいはてなブロック
 TILEMAP[12][28] = 2
 
-# --- 床(t==1)のみ返す。ブロック(t==2)はBlockクラスで管理 ---
-def get_tile_rects():
-    rects = []
-    for y, row in enumerate(TILEMAP):
-        for x, t in enumerate(row):
-            if t == 1:  # 床だけ
-                rects.append(pygame.Rect(x * TILE_SIZE_SCALED, y * TILE_SIZE_SCALED, TILE_SIZE_SCALED, TILE_SIZE_SCALED))
-    return rects
-
-class Mario(pygame.sprite.Sprite):
-    def __init__(self, images, pos, tile_rects, blocks):
+# --- レベル（タイルコードを列優先で並べたuint8） ---
+# 横に長いレベルでも見えている列だけを読めば済むよう、1列分のタイルを連続させて持つ
+# dataはbytesでも、level_format.load_levelでメモリマップしたファイルでもよい
+class Level:
+    def __init__(self, rows, cols, data):
+        self.rows = rows
+        self.cols = cols
+        self.data = data  # data[col * rows + row] がタイルコード
+        self.pixel_width = cols * TILE_SIZE_SCALED
+        self.pixel_height = rows * TILE_SIZE_SCALED
+
+    @classmethod
+    def from_tilemap(cls, tilemap):
+        rows = len(tilemap)
+        cols = len(tilemap[0])
+        return cls(rows, cols, bytes(tilemap[row][col] for col in range(cols) for row in range(rows)))
+
+    def column(self, col):
+        # 1列分のタイルコード（上の行から順）
+        return self.data[col * self.rows:(col + 1) * self.rows]
+
+DEFAULT_LEVEL = Level.from_tilemap(TILEMAP)
+
+# --- 床タイルの当たり判定用の矩形（レベルのコンパイル） ---
+# 変化しない床タイル（コード1）を、横に続くものをまとめてから同じ幅で縦に続くものをまとめ、
+# できるだけ少ない矩形にしておく（下2行の床なら、1チャンク分が1つの矩形になる）。
+# レベル全体は読まず、当たり判定で列に触れた時にその列を含むCOLLIDER_CHUNK列分だけをコンパイルする
+# （メモリマップした長いレベルでも、読むのはキャラの周りのページだけ）。
+# コンパイルしたチャンクはLevelごとにCOLLIDER_CACHE_CHUNKS個まで残し、古いものから捨てる
+SOLID_RUN = re.compile(rb"\x01+")  # 床タイル（コード1）が続いているところ
+COLLIDER_CHUNK_BITS = 6
+COLLIDER_CHUNK = 1 << COLLIDER_CHUNK_BITS  # 1回にコンパイルする列数
+COLLIDER_CACHE_CHUNKS = 64  # Levelごとに残しておくチャンクの数
+
+class LevelColliders:
+    def __init__(self, level):
+        # _level_collidersの値がキーのLevelを生かし続けないよう、Levelは弱参照で持つ
+        self._level = weakref.ref(level)
+        self.chunks = {}  # チャンク番号 -> 列ごとの、その列に掛かる矩形 (left, top, right, bottom) のタプルのタプル
+
+    def column(self, col):
+        # col列に掛かる床の矩形（ピクセル単位）のタプル。colはレベルの列の範囲内
+        chunks = self.chunks
+        index = col >> COLLIDER_CHUNK_BITS
+        columns = chunks.get(index)
+        if columns is None:
+            if len(chunks) >= COLLIDER_CACHE_CHUNKS:
+                del chunks[next(iter(chunks))]
+            columns = chunks[index] = self._compile(index)
+        return columns[col & (COLLIDER_CHUNK - 1)]
+
+    def _compile(self, index):
+        level = self._level()
+        rows = level.rows
+        first = index * COLLIDER_CHUNK
+        count = min(COLLIDER_CHUNK, level.cols - first)
+        data = bytes(level.data[first * rows:(first + count) * rows])
+        # 行ごとに横に続く床を (左の列, 右の列+1) にまとめ、上の行と同じ幅なら縦に伸ばす
+        rects = []  # (left, top, right, bottom)（チャンク内のタイル単位）
+        open_rects = {}  # (左の列, 右の列+1) -> 伸ばしている矩形の上の行
+        for row in range(rows + 1):
+            runs = {match.span() for match in SOLID_RUN.finditer(data[row::rows])} if row < rows else set()
+            for span in [span for span in open_rects if span not in runs]:
+                rects.append((span[0], open_rects.pop(span), span[1], row))
+            for span in runs:
+                open_rects.setdefault(span, row)
+        rects.sort(key=lambda rect: (rect[1], rect[0]))
+        # ピクセル単位にして、列ごとにその列に掛かる矩形のタプルを作る（同じ中身のタプルは共有する）
+        columns = [[] for _ in range(count)]
+        for left, top, right, bottom in rects:
+            pixel_rect = ((first + left) * TILE_SIZE_SCALED, top * TILE_SIZE_SCALED,
+                          (first + right) * TILE_SIZE_SCALED, bottom * TILE_SIZE_SCALED)
+            for col in range(left, right):
+                columns[col].append(pixel_rect)
+        shared = {}
+        return tuple([shared.setdefault(tuple(column), tuple(column)) for column in columns])
+
+_level_colliders = weakref.WeakKeyDictionary()  # Level -> LevelColliders
+
+def level_colliders(level):
+    # levelの床の矩形。同じLevelを使うGameどうしでコンパイルしたチャンクを共有する
+    colliders = _level_colliders.get(level)
+    if colliders is None:
+        colliders = _level_colliders[level] = LevelColliders(level)
+    return colliders
+
+# --- 当たり判定用の一様グリッド ---
+# 床タイルはコンパイルした矩形を列ごとに引き、Blockはタイルのセル単位で登録しておいて、矩形が掛かるセルだけを調べる
+# （レベルごとに1回だけ構築する。マップの広さに関係なく1回の問い合わせは数セル分）
+class CollisionGrid:
+    def __init__(self, level):
+        self.level = level
+        self.colliders = level_colliders(level)  # 床の矩形（触れた列の分だけコンパイルする）
+        self.map_pixel_width = level.pixel_width  # マップのピクセル幅
+        self.blocks = {}  # (列, 行) -> その位置を基準にしたBlockのリスト
+        self.columns = {}  # 列 -> その列のBlockのリスト
+        self.block_reach = 0  # 跳ね上がり中のブロックが基準セルから上にはみ出す最大行数
+
+    def add_block(self, block):
+        col = block.base_x // TILE_SIZE_SCALED
+        cell = (col, block.base_y // TILE_SIZE_SCALED)
+        self.blocks.setdefault(cell, []).append(block)
+        self.columns.setdefault(col, []).append(block)
+        # 跳ね上がりの最高到達点から、何行上まで食い込むかを求める
+        height = 0.0
+        vy = block.bounce_speed
+        while vy < 0:
+            height -= vy
+            vy += block.bounce_gravity
+        reach = -(-int(height) // TILE_SIZE_SCALED)
+        if reach > self.block_reach:
+            self.block_reach = reach
+
+    def remove_block(self, block):
+        col = block.base_x // TILE_SIZE_SCALED
+        cell = (col, block.base_y // TILE_SIZE_SCALED)
+        self.blocks[cell].remove(block)
+        if not self.blocks[cell]:
+            del self.blocks[cell]
+        self.columns[col].remove(block)
+        if not self.columns[col]:
+            del self.columns[col]
+
+    def blocks_in(self, left, top, right, bottom):
+        # left〜right, top〜bottomに掛かるかもしれないBlockを行優先順で返す
+        # 跳ね上がり中のブロックも拾えるよう、下方向にblock_reach行だけ広げて調べる
+        blocks = self.blocks
+        found = []
+        if not blocks:
+            return found
+        for row in range(top // TILE_SIZE_SCALED, (bottom - 1) // TILE_SIZE_SCALED + 1 + self.block_reach):
+            for col in range(left // TILE_SIZE_SCALED, (right - 1) // TILE_SIZE_SCALED + 1):
+                cell_blocks = blocks.get((col, row))
+                if cell_blocks is not None:
+                    found.extend(cell_blocks)
+        return found
+
+    def sweep_x(self, left, top, right, bottom, dx):
+        # 矩形をdx（0以外）だけ横に動かす間に一番手前で当たる床かブロックまでの移動量を返す（当たらなければdx）
+        # 動く前から動いた後までの範囲をまとめて調べるので、速くても薄いものをすり抜けない
+        column = self.colliders.column
+        last_col = self.level.cols - 1
+        if dx > 0:
+            end = right + dx
+            limit = end
+            # 床の矩形は、動く範囲に掛かる列に掛かっているものだけを調べる（元から重なっている床はその列の左端で止める）
+            start = left // TILE_SIZE_SCALED * TILE_SIZE_SCALED
+            for col in range(max(left // TILE_SIZE_SCALED, 0), min((end - 1) // TILE_SIZE_SCALED, last_col) + 1):
+                for rect_left, rect_top, rect_right, rect_bottom in column(col):
+                    if rect_top < bottom and rect_bottom > top:
+                        edge = rect_left if rect_left > start else start
+                        if edge < limit:
+                            limit = edge
+            for block in self.blocks_in(left, top, end, bottom):
+                rect = block.rect
+                if rect.left < limit and rect.right > left and rect.top < bottom and rect.bottom > top:
+                    limit = rect.left
+            return limit - right
+        end = left + dx
+        limit = end
+        start = ((right - 1) // TILE_SIZE_SCALED + 1) * TILE_SIZE_SCALED
+        for col in range(max(end // TILE_SIZE_SCALED, 0), min((right - 1) // TILE_SIZE_SCALED, last_col) + 1):
+            for rect_left, rect_top, rect_right, rect_bottom in column(col):
+                if rect_top < bottom and rect_bottom > top:
+                    edge = rect_right if rect_right < start else start
+                    if edge > limit:
+                        limit = edge
+        for block in self.blocks_in(end, top, right, bottom):
+            rect = block.rect
+            if rect.right > limit and rect.left < right and rect.top < bottom and rect.bottom > top:
+                limit = rect.right
+        return limit - left
+
+    def sweep_y(self, left, top, right, bottom, dy):
+        # sweep_xの縦方向版。(移動量, 止めたのがブロックか) を返す（床とブロックが同じ位置なら床）
+        column = self.colliders.column
+        first_col = max(left // TILE_SIZE_SCALED, 0)
+        last_col = min((right - 1) // TILE_SIZE_SCALED, self.level.cols - 1)
+        hit_block = False
+        if dy > 0:
+            end = bottom + dy
+            limit = end
+            start = top // TILE_SIZE_SCALED * TILE_SIZE_SCALED
+            for col in range(first_col, last_col + 1):
+                for rect_left, rect_top, rect_right, rect_bottom in column(col):
+                    if rect_top < end and rect_bottom > top:
+                        edge = rect_top if rect_top > start else start
+                        if edge < limit:
+                            limit = edge
+            for block in self.blocks_in(left, top, right, end):
+                rect = block.rect
+                if rect.top < limit and rect.bottom > top and rect.left < right and rect.right > left:
+                    limit = rect.top
+                    hit_block = True
+            return limit - bottom, hit_block
+        end = top + dy
+        limit = end
+        start = ((bottom - 1) // TILE_SIZE_SCALED + 1) * TILE_SIZE_SCALED
+        for col in range(first_col, last_col + 1):
+            for rect_left, rect_top, rect_right, rect_bottom in column(col):
+                if rect_bottom > end and rect_top < bottom:
+                    edge = rect_bottom if rect_bottom < start else start
+                    if edge > limit:
+                        limit = edge
+        for block in self.blocks_in(left, end, right, bottom):
+            rect = block.rect
+            if rect.bottom > limit and rect.top < bottom and rect.left < right and rect.right > left:
+                limit = rect.bottom
+                hit_block = True
+        return limit - top, hit_block
+
+# --- 床タイルを焼き込んだ背景レイヤー ---
+# 床は変化しないので、画面幅ごとのチャンクSurfaceに空色と床タイルを1回だけ描いておき、
+# 毎フレームはカメラ位置に合わせてチャンクを1〜2枚blitするだけにする
+SKY_COLOR = (92, 148, 252)  # マリオの空色
+
+class StaticLayer:
+    def __init__(self, wall_img, level, chunk_width=SCREEN_WIDTH * SCALE, max_chunks=4):
+        self.wall_img = wall_img
+        self.level = level
+        self.chunk_width = chunk_width
+        self.width = level.pixel_width
+        self.height = level.pixel_height
+        # チャンク番号 -> 焼き込み済みSurface（初めて映った時に作り、max_chunksを超えたら古いものから捨てる）
+        self.max_chunks = max_chunks
+        self.chunks = {}
+
+    def _bake(self, index):
+        left = index * self.chunk_width
+        width = min(self.chunk_width, self.width - left)
+        chunk = pygame.Surface((width, self.height))
+        if pygame.display.get_surface() is not None:
+            chunk = chunk.convert()
+        chunk.fill(SKY_COLOR)
+        first_col = left // TILE_SIZE_SCALED
+        last_col = (left + width - 1) // TILE_SIZE_SCALED
+        for x in range(first_col, last_col + 1):
+            for y, t in enumerate(self.level.column(x)):
+                if t == 1:
+                    chunk.blit(self.wall_img, (x * TILE_SIZE_SCALED - left, y * TILE_SIZE_SCALED))
+        if len(self.chunks) >= self.max_chunks:
+            del self.chunks[next(iter(self.chunks))]
+        self.chunks[index] = chunk
+        return chunk
+
+    def draw(self, surface, camera_x):
+        view_width = surface.get_width()
+        first = camera_x // self.chunk_width
+        last = (min(camera_x + view_width, self.width) - 1) // self.chunk_width
+        for index in range(first, last + 1):
+            chunk = self.chunks.pop(index, None)
+            if chunk is None:
+                chunk = self._bake(index)
+            else:
+                self.chunks[index] = chunk  # 最近使った順に並べ直す
+            surface.blit(chunk, (index * self.chunk_width - camera_x, 0))
+        # マップが画面より狭い場合は残りを空色で塗る
+        if camera_x + view_width > self.width:
+            surface.fill(SKY_COLOR, (self.width - camera_x, 0, camera_x + view_width - self.width, surface.get_height()))
+
+# --- 床とブロックに当たりながら動くもの（マリオ・クリボー・キノコ共通） ---
+# 位置はrect（整数ピクセル）と、1ピクセルをSUBPIXELSに分けた端数 sub_x, sub_y（固定小数点）で持つ。
+# 速度の小数部分も切り捨てずに端数にためていくので、どの速さでも平均すれば速度どおりに進む
+SUBPIXEL_BITS = 8
+SUBPIXELS = 1 << SUBPIXEL_BITS  # snapshotでは端数を1バイト（"B"）で持つので256まで
+SUBPIXEL_MASK = SUBPIXELS - 1
+
+# move_y()の戻り値（move_x()は当たったかどうかだけを返す）
+HIT_NONE = 0
+HIT_GROUND = 1  # 下に動いて床かブロックに乗った
+HIT_CEILING = 2  # 上に動いて床に頭をぶつけた
+HIT_BLOCK = 3  # 上に動いてブロックに頭をぶつけた
+
+class Body:
+    # 使う側は rect, sub_x, sub_y, collision（CollisionGrid）を持つこと
+    __slots__ = ()
+
+    def move_x(self, vx):
+        # vxだけ横に動かす。床かブロックに当たったらその手前で止めてTrueを返す
+        rect = self.rect
+        x = rect.x
+        position = (x << SUBPIXEL_BITS) + self.sub_x + int(vx * SUBPIXELS)
+        dx = (position >> SUBPIXEL_BITS) - x
+        if dx:
+            y = rect.y
+            moved = self.collision.sweep_x(x, y, x + rect.width, y + rect.height, dx)
+            if moved != dx:
+                rect.x = x + moved
+                self.sub_x = 0
+                return True
+            rect.x = x + dx
+        self.sub_x = position & SUBPIXEL_MASK
+        return False
+
+    def move_y(self, vy):
+        # vyだけ縦に動かす。当たったらその手前で止めて、何に当たったか（HIT_*）を返す
+        rect = self.rect
+        y = rect.y
+        position = (y << SUBPIXEL_BITS) + self.sub_y + int(vy * SUBPIXELS)
+        dy = (position >> SUBPIXEL_BITS) - y
+        if dy:
+            x = rect.x
+            moved, hit_block = self.collision.sweep_y(x, y, x + rect.width, y + rect.height, dy)
+            if moved != dy:
+                rect.y = y + moved
+                self.sub_y = 0
+                if dy > 0:
+                    return HIT_GROUND
+                return HIT_BLOCK if hit_block else HIT_CEILING
+            rect.y = y + dy
+        self.sub_y = position & SUBPIXEL_MASK
+        return HIT_NONE
+
+class Mario(pygame.sprite.Sprite, Body):
+    # snapshot用の状態: x, y, sub_x, sub_y, vx, vy, on_ground, facing_right, walk_frame, walk_timer, jumping, jump_hold_count,
+    #                   dead, death_timer, image_id
+    STATE_FORMAT = "iiBBdd??ii?i?ii"
+
+    def __init__(self, atlas, pos, collision):
         super().__init__()
-        self.images = images  # dict: stand, walk(list), jump, death
-        self.image = self.images['stand']
-        self.rect = self.image.get_rect()
+        self.atlas = atlas
+        # 状態ごとの画像番号（右向き。左向きは+1）
+        self.frame_ids = {
+            'stand': atlas.id('mario_stand'),
+            'walk': [atlas.id('mario_walk1'), atlas.id('mario_walk2'), atlas.id('mario_walk3')],
+            'jump': atlas.id('mario_jump'),
+            'death': atlas.id('mario_death'),
+        }
+        self.MARIO_WALK_ANIM_INTERVAL = 6
+        self.MARIO_DEATH_JUMP_VY = MARIO_DEATH_JUMP_VY
+        self.MARIO_DEATH_GRAVITY = MARIO_DEATH_GRAVITY
+        self.MARIO_DEATH_DURATION = MARIO_DEATH_DURATION
+        self.collision = collision  # CollisionGrid（床とブロックの当たり判定）
+        self.rect = atlas.frames[self.frame_ids['stand']].get_rect()
+        self.spawn(pos)
+
+    def spawn(self, pos):
+        # 出現した直後の状態にする（Game.reset()で同じインスタンスを使い回す）
+        self.image_id = self.frame_ids['stand']
+        self.image = self.atlas.frames[self.image_id]
+        self.rect.size = self.image.get_size()
         self.rect.midbottom = pos
+        self.sub_x = 0
+        self.sub_y = 0
         self.vx = 0.0
         self.vy = 0.0
         self.on_ground = False
         self.facing_right = True
         self.walk_frame = 0
         self.walk_timer = 0
-        self.MARIO_WALK_ANIM_INTERVAL = 6
         self.jumping = False
         self.jump_hold_count = 0
         self.dead = False
         self.death_timer = 0
-        self.MARIO_DEATH_JUMP_VY = -8.0 * SCALE
-        self.MARIO_DEATH_GRAVITY = 0.35 * SCALE
-        self.MARIO_DEATH_DURATION = 120
-        self.tile_rects = tile_rects
-        self.blocks = blocks  # Blockインスタンスのリスト
 
     def update(self, keys):
         if not self.dead:
@@ -195,101 +554,82 @@ class Mario(pygame.sprite.Sprite):
                     self.jump_hold_count = 0
                     self.on_ground = False
                 elif self.jumping and self.jump_hold_count < JUMP_HOLD_TIME:
-                    self.vy -= 0.35 * SCALE
+                    self.vy -= JUMP_HOLD_POWER
                     self.jump_hold_count += 1
             else:
                 self.jumping = False
 
-            # 横移動
-            self.rect.x += int(self.vx)
-            # 横方向の当たり判定（床）
-            for tile in self.tile_rects():
-                if self.rect.colliderect(tile):
-                    if self.vx > 0:
-                        self.rect.right = tile.left
-                        self.vx = 0
-                    elif self.vx < 0:
-                        self.rect.left = tile.right
-                        self.vx = 0
-            # 横方向の当たり判定（ブロック）
-            for block in self.blocks:
-                if self.rect.colliderect(block.rect):
-                    if self.vx > 0:
-                        self.rect.right = block.rect.left
-                        self.vx = 0
-                    elif self.vx < 0:
-                        self.rect.left = block.rect.right
-                        self.vx = 0
+            # 横移動（床かブロックに当たったら止まる）
+            if self.move_x(self.vx):
+                self.vx = 0
 
-            # 重力
+            # 重力と縦移動
             self.vy += GRAVITY
-            self.rect.y += int(self.vy)
             self.on_ground = False
-            # 縦方向の当たり判定（床）
-            for tile in self.tile_rects():
-                if self.rect.colliderect(tile):
-                    if self.vy > 0:
-                        self.rect.bottom = tile.top
-                        self.vy = 0
-                        self.on_ground = True
-                        self.jumping = False
-                        self.jump_hold_count = 0
-                    elif self.vy < 0:
-                        self.rect.top = tile.bottom
-                        self.vy = 0
-            # 縦方向の当たり判定（ブロック）
-            for block in self.blocks:
-                if self.rect.colliderect(block.rect):
-                    if self.vy > 0:
-                        self.rect.bottom = block.rect.top
-                        self.vy = 0
-                        self.on_ground = True
-                        self.jumping = False
-                        self.jump_hold_count = 0
-                    elif self.vy < 0:
-                        # ブロックは跳ね上がるが、床は跳ね上がらない
-                        # ここでvyを0にしてしまうと、mainループでの跳ね上がり判定に使えない
-                        # vyを0にせず、mainループでの跳ね上がり判定後にvyを0にする
-                        self.rect.top = block.rect.bottom
-                        # self.vy = 0  # ここをコメントアウトまたは削除
+            hit = self.move_y(self.vy)
+            if hit == HIT_GROUND:
+                self.vy = 0
+                self.on_ground = True
+                self.jumping = False
+                self.jump_hold_count = 0
+            elif hit == HIT_CEILING:
+                self.vy = 0
+            # HIT_BLOCK: ブロックは跳ね上がるが、床は跳ね上がらない
+            # ここでvyを0にしてしまうと、Game.updateでの跳ね上がり判定に使えない
+            # vyを0にせず、跳ね上がり判定後にvyを0にする
 
             # マップ外に出ないように（マップ全体の範囲で制限）
-            map_pixel_width = len(TILEMAP[0]) * TILE_SIZE_SCALED
+            map_pixel_width = self.collision.map_pixel_width
             if self.rect.left < 0:
                 self.rect.left = 0
+                self.sub_x = 0
                 self.vx = 0
             if self.rect.right > map_pixel_width:
                 self.rect.right = map_pixel_width
+                self.sub_x = 0
                 self.vx = 0
 
             # アニメーション
             if abs(self.vx) > 0.5 and self.on_ground:
                 self.walk_timer += 1
                 if self.walk_timer >= self.MARIO_WALK_ANIM_INTERVAL:
-                    self.walk_frame = (self.walk_frame + 1) % len(self.images['walk'])
+                    self.walk_frame = (self.walk_frame + 1) % len(self.frame_ids['walk'])
                     self.walk_timer = 0
-                self.image = self.images['walk'][self.walk_frame]
+                image_id = self.frame_ids['walk'][self.walk_frame]
             elif not self.on_ground:
-                self.image = self.images['jump']
+                image_id = self.frame_ids['jump']
                 self.walk_frame = 0
                 self.walk_timer = 0
             else:
-                self.image = self.images['stand']
+                image_id = self.frame_ids['stand']
                 self.walk_frame = 0
                 self.walk_timer = 0
 
+            # 左向きは反転済みの画像（番号+1）を使う
             if not self.facing_right:
-                self.image = pygame.transform.flip(self.image, True, False)
+                image_id += 1
+            self.image_id = image_id
+            self.image = self.atlas.frames[image_id]
         else:
             # 死亡時
             self.vx = 0
             self.vy += self.MARIO_DEATH_GRAVITY
             self.rect.y += int(self.vy)
             self.death_timer += 1
-            self.image = self.images['death']
+            self.image_id = self.frame_ids['death']
+            self.image = self.atlas.frames[self.image_id]
             if self.death_timer > self.MARIO_DEATH_DURATION or self.rect.top > SCREEN_HEIGHT * SCALE:
                 return 'dead'  # signal to quit
 
+    def get_state(self):
+        return (self.rect.x, self.rect.y, self.sub_x, self.sub_y, self.vx, self.vy, self.on_ground, self.facing_right,
+                self.walk_frame, self.walk_timer, self.jumping, self.jump_hold_count, self.dead, self.death_timer, self.image_id)
+
+    def set_state(self, state):
+        (self.rect.x, self.rect.y, self.sub_x, self.sub_y, self.vx, self.vy, self.on_ground, self.facing_right,
+         self.walk_frame, self.walk_timer, self.jumping, self.jump_hold_count, self.dead, self.death_timer, self.image_id) = state
+        self.image = self.atlas.frames[self.image_id]
+
     def die(self):
         self.dead = True
         self.death_timer = 0
@@ -297,26 +637,38 @@ class Mario(pygame.sprite.Sprite):
         self.jumping = False
         self.on_ground = False
 
-class Kuribo(pygame.sprite.Sprite):
-    def __init__(self, images, death_img, pos, tile_rects, blocks):
-        super().__init__()
+# 数が多く、出ては消えるのでSpriteにはせず__slots__で小さくする（GameのEntityPoolで使い回す）
+class Kuribo(Body):
+    # snapshot用の状態: x, y, 幅, 高さ, sub_x, sub_y, vx, vy, on_ground, frame, timer, squashed, squash_timer, _alive
+    STATE_FORMAT = "iiiiBBdd?ii?i?"
+    KURIBO_ANIM_INTERVAL = 16
+    KURIBO_SQUASH_DURATION = 40
+
+    __slots__ = ('images', 'death_img', 'image', 'rect', 'sub_x', 'sub_y', 'vx', 'vy', 'on_ground', 'frame', 'timer',
+                 'squashed', 'squash_timer', '_alive', 'collision')
+
+    def __init__(self, images, death_img, pos, collision):
         self.images = images  # list: walk frames
         self.death_img = death_img
+        self.rect = self.images[0].get_rect()
+        self.spawn(pos, collision)
+
+    def spawn(self, pos, collision):
+        # 出現した直後の状態にする（プールから取り出した時も使う）
         self.image = self.images[0]
-        self.rect = self.image.get_rect()
+        self.rect.size = self.image.get_size()
         self.rect.midbottom = pos
+        self.sub_x = 0
+        self.sub_y = 0
         self.vx = -KURIBO_WALK_SPEED
         self.vy = 0.0
         self.on_ground = False
         self.frame = 0
         self.timer = 0
-        self.KURIBO_ANIM_INTERVAL = 16
         self.squashed = False
         self.squash_timer = 0
-        self.KURIBO_SQUASH_DURATION = 40
         self._alive = True
-        self.tile_rects = tile_rects
-        self.blocks = blocks  # Blockインスタンスのリスト
+        self.collision = collision  # CollisionGrid（床とブロックの当たり判定）
 
     @property
     def alive(self):
@@ -324,57 +676,26 @@ class Kuribo(pygame.sprite.Sprite):
 
     def update(self):
         if not self.squashed:
-            self.rect.x += int(self.vx)
-            # 横方向の当たり判定（床）
-            for tile in self.tile_rects():
-                if self.rect.colliderect(tile):
-                    if self.vx > 0:
-                        self.rect.right = tile.left
-                        self.vx = -KURIBO_WALK_SPEED
-                    elif self.vx < 0:
-                        self.rect.left = tile.right
-                        self.vx = KURIBO_WALK_SPEED
-            # 横方向の当たり判定（ブロック）
-            for block in self.blocks:
-                if self.rect.colliderect(block.rect):
-                    if self.vx > 0:
-                        self.rect.right = block.rect.left
-                        self.vx = -KURIBO_WALK_SPEED
-                    elif self.vx < 0:
-                        self.rect.left = block.rect.right
-                        self.vx = KURIBO_WALK_SPEED
+            # 床かブロックに当たったら反転
+            if self.move_x(self.vx):
+                self.vx = KURIBO_WALK_SPEED if self.vx < 0 else -KURIBO_WALK_SPEED
 
             self.vy += KURIBO_GRAVITY
-            self.rect.y += int(self.vy)
             self.on_ground = False
-            # 縦方向の当たり判定（床）
-            for tile in self.tile_rects():
-                if self.rect.colliderect(tile):
-                    if self.vy > 0:
-                        self.rect.bottom = tile.top
-                        self.vy = 0
-                        self.on_ground = True
-                    elif self.vy < 0:
-                        self.rect.top = tile.bottom
-                        self.vy = 0
-            # 縦方向の当たり判定（ブロック）
-            for block in self.blocks:
-                if self.rect.colliderect(block.rect):
-                    if self.vy > 0:
-                        self.rect.bottom = block.rect.top
-                        self.vy = 0
-                        self.on_ground = True
-                    elif self.vy < 0:
-                        self.rect.top = block.rect.bottom
-                        self.vy = 0
+            hit = self.move_y(self.vy)
+            if hit != HIT_NONE:
+                self.vy = 0
+                self.on_ground = hit == HIT_GROUND
 
             # マップ端で反転
-            map_pixel_width = len(TILEMAP[0]) * TILE_SIZE_SCALED
+            map_pixel_width = self.collision.map_pixel_width
             if self.rect.left < 0:
                 self.rect.left = 0
+                self.sub_x = 0
                 self.vx = KURIBO_WALK_SPEED
             if self.rect.right > map_pixel_width:
                 self.rect.right = map_pixel_width
+                self.sub_x = 0
                 self.vx = -KURIBO_WALK_SPEED
 
             # アニメーション
@@ -387,12 +708,23 @@ class Kuribo(pygame.sprite.Sprite):
             self.squash_timer += 1
             self.image = self.death_img
             # 潰れた画像の下端を元のクリボーの下端に合わせる
-            death_rect = self.death_img.get_rect()
-            death_rect.midbottom = self.rect.midbottom
-            self.rect = death_rect
+            bottom = self.rect.midbottom
+            self.rect.size = self.death_img.get_size()
+            self.rect.midbottom = bottom
             if self.squash_timer >= self.KURIBO_SQUASH_DURATION:
                 self._alive = False
 
+    def get_state(self):
+        rect = self.rect
+        return (rect.x, rect.y, rect.width, rect.height, self.sub_x, self.sub_y, self.vx, self.vy, self.on_ground,
+                self.frame, self.timer, self.squashed, self.squash_timer, self._alive)
+
+    def set_state(self, state):
+        rect = self.rect
+        (rect.x, rect.y, rect.width, rect.height, self.sub_x, self.sub_y, self.vx, self.vy, self.on_ground,
+         self.frame, self.timer, self.squashed, self.squash_timer, self._alive) = state
+        self.image = self.death_img if self.squashed else self.images[self.frame]
+
     def squash(self):
         self.squashed = True
         self.squash_timer = 0
@@ -400,26 +732,46 @@ class Kuribo(pygame.sprite.Sprite):
         self.vy = 0
 
 # --- キノコクラス ---
-class Mushroom(pygame.sprite.Sprite):
-    def __init__(self, image, x, y, tile_rects, blocks):
-        super().__init__()
+# Kuriboと同じく__slots__で小さくし、GameのEntityPoolで使い回す
+class Mushroom(Body):
+    # snapshot用の状態: x, y, sub_x, sub_y, vx, vy, spawn_progress, spawning, on_ground, _target_bottom
+    STATE = struct.Struct("<iiBBddi??i")
+    # 出現アニメーション用
+    spawn_height = TILE_SIZE_SCALED  # 1ブロック分せり上がる
+    spawn_speed = 1  # 1フレームに1pxずつ上昇（ゆっくり）
+    GRAVITY = GRAVITY
+
+    __slots__ = ('image', 'rect', 'sub_x', 'sub_y', 'spawn_progress', 'spawning', 'vx', 'vy', 'collision', 'on_ground',
+                 '_target_bottom')
+
+    def __init__(self, image, x, y, collision):
         self.image = image
-        # 出現アニメーション用
-        self.spawn_height = TILE_SIZE_SCALED  # 1ブロック分せり上がる
-        self.spawn_speed = 1  # 1フレームに1pxずつ上昇（ゆっくり）
+        self.rect = self.image.get_rect()
+        self.spawn(x, y, collision)
+
+    def spawn(self, x, y, collision):
+        # 出現した直後の状態にする（プールから取り出した時も使う）
         self.spawn_progress = 0
         self.spawning = True
         # yはブロックの下端。そこからspawn_height分だけ上にせり上がる
-        self.rect = self.image.get_rect(midbottom=(x, y))
+        self.rect.midbottom = (x, y)
+        self.sub_x = 0
+        self.sub_y = 0
         # 速度設定（クリボーの半分、右向きで開始）
         self.vx = abs(KURIBO_WALK_SPEED / 2)
         self.vy = 0.0
-        self.tile_rects = tile_rects
-        self.blocks = blocks
+        self.collision = collision
         self.on_ground = False
-        self.GRAVITY = GRAVITY
         self._target_bottom = y - self.spawn_height
 
+    def get_state(self):
+        return (self.rect.x, self.rect.y, self.sub_x, self.sub_y, self.vx, self.vy, self.spawn_progress, self.spawning,
+                self.on_ground, self._target_bottom)
+
+    def set_state(self, state):
+        (self.rect.x, self.rect.y, self.sub_x, self.sub_y, self.vx, self.vy, self.spawn_progress, self.spawning,
+         self.on_ground, self._target_bottom) = state
+
     def update(self):
         if self.spawning:
             # 上にせり上がるアニメーション
@@ -432,184 +784,714 @@ class Mushroom(pygame.sprite.Sprite):
             return
 
         # 横移動（右向きで開始、以降は壁やブロックで反転）
-        self.rect.x += int(self.vx)
-        # 横方向の当たり判定（床）
-        for tile in self.tile_rects():
-            if self.rect.colliderect(tile):
-                if self.vx > 0:
-                    self.rect.right = tile.left
-                    self.vx = -self.vx
-                elif self.vx < 0:
-                    self.rect.left = tile.right
-                    self.vx = -self.vx
-        # 横方向の当たり判定（ブロック）
-        for block in self.blocks:
-            if self.rect.colliderect(block.rect):
-                if self.vx > 0:
-                    self.rect.right = block.rect.left
-                    self.vx = -self.vx
-                elif self.vx < 0:
-                    self.rect.left = block.rect.right
-                    self.vx = -self.vx
+        if self.move_x(self.vx):
+            self.vx = -self.vx
 
         # 重力
         self.vy += self.GRAVITY
-        self.rect.y += int(self.vy)
         self.on_ground = False
-        # 縦方向の当たり判定（床）
-        for tile in self.tile_rects():
-            if self.rect.colliderect(tile):
-                if self.vy > 0:
-                    self.rect.bottom = tile.top
-                    self.vy = 0
-                    self.on_ground = True
-                elif self.vy < 0:
-                    self.rect.top = tile.bottom
-                    self.vy = 0
-        # 縦方向の当たり判定（ブロック）
-        for block in self.blocks:
-            if self.rect.colliderect(block.rect):
-                if self.vy > 0:
-                    self.rect.bottom = block.rect.top
-                    self.vy = 0
-                    self.on_ground = True
-                elif self.vy < 0:
-                    self.rect.top = block.rect.bottom
-                    self.vy = 0
-
-def main():
-    pygame.init()
-    screen = pygame.display.set_mode((SCREEN_WIDTH * SCALE, SCREEN_HEIGHT * SCALE))
-    pygame.display.set_caption("スーパーマリオ風")
-
-    # 画像の読み込み
-    mario_stand = load_and_scale(os.path.join("images", "mario001.png"))
-    mario_walk = [
-        load_and_scale(os.path.join("images", "mario002.png")),
-        load_and_scale(os.path.join("images", "mario003.png")),
-        load_and_scale(os.path.join("images", "mario004.png")),
-    ]
-    mario_jump = load_and_scale(os.path.join("images", "mario_jump.png"))
-    mario_death = load_and_scale(os.path.join("images", "mario_death.png"))
-
-    kuribo_img = load_and_scale(os.path.join("images", "kuribo.png"))
-    kuribo_walk = [
-        kuribo_img,
-        pygame.transform.flip(kuribo_img, True, False)
-    ]
-    kuribo_death_img = load_and_scale(os.path.join("images", "kuribo_death.png"))
-
+        hit = self.move_y(self.vy)
+        if hit != HIT_NONE:
+            self.vy = 0
+            self.on_ground = hit == HIT_GROUND
+
+# --- スプライトアトラス ---
+# 全画像を読み込み時に「右向き」「左向き（左右反転）」の2枚ずつ用意して番号で引けるようにする
+# （描画中にpygame.transform.flipでSurfaceを作らずに済む）
+class SpriteAtlas:
+    def __init__(self):
+        self.frames = []  # 画像番号 -> Surface（偶数: 右向き、奇数: 左向き）
+        self.ids = {}  # 名前 -> 右向きの画像番号
+
+    def add(self, name, image, mirrored=None):
+        # mirroredを省略すると左右反転した画像をここで作る
+        if mirrored is None:
+            mirrored = pygame.transform.flip(image, True, False)
+        self.ids[name] = len(self.frames)
+        self.frames.append(image)
+        self.frames.append(mirrored)
+
+    def id(self, name, facing_right=True):
+        return self.ids[name] if facing_right else self.ids[name] + 1
+
+    def image(self, name, facing_right=True):
+        return self.frames[self.id(name, facing_right)]
+
+# アトラスに登録する画像（名前, ファイル名）
+SPRITE_FILES = [
+    ('mario_stand', "mario001.png"),
+    ('mario_walk1', "mario002.png"),
+    ('mario_walk2', "mario003.png"),
+    ('mario_walk3', "mario004.png"),
+    ('mario_jump', "mario_jump.png"),
+    ('mario_death', "mario_death.png"),
+    ('mario_big_stand', "mario_big001.png"),
+    ('mario_big_walk1', "mario_big002.png"),
+    ('mario_big_walk2', "mario_big003.png"),
+    ('mario_big_walk3', "mario_big004.png"),
+    ('kuribo', "kuribo.png"),
+    ('kuribo_death', "kuribo_death.png"),
     # タイル画像
-    wall_img = load_and_scale(os.path.join("images", "wall.png"))
-    block_img = load_and_scale(os.path.join("images", "block.png"))
-    hatena_img = load_and_scale(os.path.join("images", "hatena.png"))
-    panel_img = load_and_scale(os.path.join("images", "panel.png"))
+    ('wall', "wall.png"),
+    ('block', "block.png"),
+    ('hatena', "hatena.png"),
+    ('panel', "panel.png"),
+]
+
+def load_assets(convert=True, cache_path=None):
+    # 画像の読み込み（ヘッドレス実行時はconvert=Falseでウィンドウなしに読み込む）
+    # cache_pathを指定するとスケール済みのキャッシュファイルをメモリマップして使う
+    if cache_path is not None:
+        return load_cached_assets(cache_path, convert)
+    atlas = SpriteAtlas()
+    for name, filename in SPRITE_FILES:
+        atlas.add(name, load_and_scale(os.path.join(IMAGE_DIR, filename), convert))
 
-    # キノコ画像（なければblock_imgで仮）
+    # キノコ画像（なければblock画像で仮）
     try:
-        mushroom_img = load_and_scale(os.path.join("images", "kinoko.png"))
+        atlas.add('mushroom', load_and_scale(os.path.join(IMAGE_DIR, "kinoko.png"), convert))
     except:
-        mushroom_img = block_img
-
-    # タイル当たり判定取得関数
-    def tile_rects():
-        return get_tile_rects()
-
-    # ブロックオブジェクトのリストを作成
-    blocks = []
-    mushrooms = []  # キノコリスト
-    def spawn_mushroom(x, y):
-        mushrooms.append(Mushroom(mushroom_img, x, y, tile_rects, blocks))
-    for y, row in enumerate(TILEMAP):
-        for x, t in enumerate(row):
-            if t == 2:
-                blocks.append(Block(block_img, x * TILE_SIZE_SCALED, y * TILE_SIZE_SCALED, block_type="normal"))
-            elif t == 3:
-                blocks.append(Block(hatena_img, x * TILE_SIZE_SCALED, y * TILE_SIZE_SCALED, block_type="hatena", alt_image=panel_img, spawn_callback=spawn_mushroom))
-
-    # スプライト生成
-    mario = Mario(
-        images={
-            'stand': mario_stand,
-            'walk': mario_walk,
-            'jump': mario_jump,
-            'death': mario_death
-        },
-        pos=(SCREEN_WIDTH * SCALE // 2, 10 * TILE_SIZE_SCALED),
-        tile_rects=tile_rects,
-        blocks=blocks
-    )
-
-    kuribo = Kuribo(
-        images=kuribo_walk,
-        death_img=kuribo_death_img,
-        pos=(80 * SCALE, 10 * TILE_SIZE_SCALED),
-        tile_rects=tile_rects,
-        blocks=blocks
-    )
-
-    all_sprites = pygame.sprite.Group()
-    all_sprites.add(mario)
-    all_sprites.add(kuribo)
-
-    clock = pygame.time.Clock()
-    running = True
-
-    # カメラのx座標
-    camera_x = 0
+        atlas.add('mushroom', atlas.image('block'))
+    return atlas
+
+def load_cached_assets(cache_path, convert=False):
+    sources = [os.path.join(IMAGE_DIR, filename) for _, filename in SPRITE_FILES]
+    mushroom_path = os.path.join(IMAGE_DIR, "kinoko.png")
+    if os.path.exists(mushroom_path):
+        sources.append(mushroom_path)
+    key = asset_cache.source_key(sources, SCALE)
+
+    cached = asset_cache.read_cache(cache_path, key)
+    if cached is None:
+        # キャッシュがないか古いので作り直す（アトラスの画像を左右両方とも書き出す）
+        atlas = load_assets(convert=False)
+        frames = []
+        for name, index in atlas.ids.items():
+            frames.append((name, atlas.frames[index]))
+            frames.append((name, atlas.frames[index + 1]))
+        asset_cache.write_cache(cache_path, key, frames)
+        cached = asset_cache.read_cache(cache_path, key)
+
+    buf, frames = cached
+    atlas = SpriteAtlas()
+    atlas.cache_buffer = buf  # Surfaceが画素を参照しているので保持しておく
+    for i in range(0, len(frames), 2):
+        (name, image), (_, mirrored) = frames[i], frames[i + 1]
+        if convert:
+            image = image.convert_alpha()
+            mirrored = mirrored.convert_alpha()
+        atlas.add(name, image, mirrored)
+    return atlas
+
+# --- 行動（step()に渡すaction）のビット ---
+ACTION_LEFT = 1
+ACTION_RIGHT = 2
+ACTION_JUMP = 4
+ACTION_DASH = 8
+
+ACTION_KEY_BITS = {
+    pygame.K_LEFT: ACTION_LEFT,
+    pygame.K_RIGHT: ACTION_RIGHT,
+    pygame.K_SPACE: ACTION_JUMP,
+    pygame.K_LSHIFT: ACTION_DASH,
+    pygame.K_RSHIFT: ACTION_DASH,
+}
+
+def action_from_keys(keys):
+    # pygame.key.get_pressed()の結果をactionのビットに変換
+    action = 0
+    for key, bit in ACTION_KEY_BITS.items():
+        if keys[key]:
+            action |= bit
+    return action
+
+class ActionKeys:
+    # actionのビットをpygame.key.get_pressed()と同じ形で引けるようにする（Mario.update用）
+    __slots__ = ('action',)
+
+    def __init__(self, action=0):
+        self.action = action
+
+    def __getitem__(self, key):
+        return bool(self.action & ACTION_KEY_BITS.get(key, 0))
+
+# --- 固定tickのシミュレーション時間管理 ---
+# シミュレーションの固定tickレート（1tick = Game.update 1回）
+TICK_RATE = 60
+# 描画が追いつかない時に1フレームで進めるtick数の上限（超えた分は捨てる）
+MAX_TICKS_PER_FRAME = 8
+
+class FixedTimestep:
+    def __init__(self, tick_rate=TICK_RATE, speed=1.0, max_ticks=MAX_TICKS_PER_FRAME):
+        self.tick_time = 1.0 / tick_rate
+        self.speed = speed
+        self.max_ticks = max_ticks
+        self.accumulator = 0.0
+
+    def advance(self, elapsed):
+        # 実時間でelapsed秒経った時に進めるtick数を返す
+        self.accumulator += elapsed * self.speed
+        ticks = int(self.accumulator / self.tick_time)
+        if ticks > self.max_ticks:
+            ticks = self.max_ticks
+            self.accumulator = 0.0  # 処理落ち分は捨てる
+        else:
+            self.accumulator -= ticks * self.tick_time
+        return ticks
 
-    # マップのピクセル幅
-    map_pixel_width = len(TILEMAP[0]) * TILE_SIZE_SCALED
+    @property
+    def alpha(self):
+        # 最後のtickから次のtickまでの進み具合（補間描画用、0.0〜1.0）
+        return self.accumulator / self.tick_time
+
+# Game.observe()の要素数
+OBS_SIZE = 6
+
+# ブロックを用意しておく、画面の左右の余白（列数）
+BLOCK_LOAD_MARGIN = 4
+# 用意したブロックの列がこれを超えたら、遠くの列を捨てる
+MAX_LOADED_COLUMNS = 64
+# 画面の左右にこれだけ（ピクセル）はみ出した範囲までのキャラを動かす。外に出たキャラは止めておき、
+# 範囲に入ったらそのまま動き出す（レベルにいるキャラの数ではなく、画面の近くにいる数だけ処理する）
+ACTIVE_MARGIN = 4 * TILE_SIZE_SCALED
+
+# --- 止まっているキャラの置き場 ---
+# 止まっているキャラは動かないので左端の列ごとに分けておき、動かす範囲に新しく入った列の分だけを調べる
+# （範囲外にいくらキャラがいても、1フレームに調べるのは範囲の端の数列分だけ）
+class SleepGrid:
+    def __init__(self):
+        self.columns = {}  # 列 -> 止まっているキャラのリスト（止めた順）
+        self.count = 0
+        self._scanned = None  # 最後に調べた範囲。止まっているキャラはどれもこの範囲に掛からない
+
+    def add(self, entity):
+        self.columns.setdefault(entity.rect.x // TILE_SIZE_SCALED, []).append(entity)
+        self.count += 1
+        scanned = self._scanned
+        if scanned is not None and entity.rect.right > scanned[0] and entity.rect.left < scanned[1]:
+            self._scanned = None  # 次は範囲全体を調べ直す
+
+    def clear(self):
+        self.columns.clear()
+        self.count = 0
+        self._scanned = None
+
+    def wake(self, left, right, awake):
+        # left〜rightの範囲に掛かるキャラをawakeの後ろに移す（列の順、列の中は止めた順）
+        scanned = self._scanned
+        self._scanned = (left, right)
+        if not self.count:
+            return
+        if scanned is None or scanned[1] <= left or right <= scanned[0]:
+            self._wake_range(left, right, awake)
+        else:
+            # 前に調べた範囲からはみ出した左右の部分だけ
+            if left < scanned[0]:
+                self._wake_range(left, scanned[0], awake)
+            if scanned[1] < right:
+                self._wake_range(scanned[1], right, awake)
+
+    def _wake_range(self, first, last, awake):
+        # first〜lastに掛かるキャラを起こす
+        columns = self.columns
+        for col in range((first - TILE_SIZE_SCALED) // TILE_SIZE_SCALED, (last - 1) // TILE_SIZE_SCALED + 1):
+            entities = columns.get(col)
+            if entities is None:
+                continue
+            staying = []
+            for entity in entities:
+                if entity.rect.right > first and entity.rect.left < last:
+                    awake.append(entity)
+                    self.count -= 1
+                else:
+                    staying.append(entity)
+            if staying:
+                columns[col] = staying
+            else:
+                del columns[col]
 
-    while running:
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
+    def near(self, left, right):
+        # left〜rightの範囲に掛かるキャラ（描画用。起こさない）
+        if not self.count:
+            return
+        columns = self.columns
+        for col in range((left - TILE_SIZE_SCALED) // TILE_SIZE_SCALED, (right - 1) // TILE_SIZE_SCALED + 1):
+            for entity in columns.get(col, ()):
+                if entity.rect.right > left and entity.rect.left < right:
+                    yield entity
+
+    def __iter__(self):
+        for entities in self.columns.values():
+            yield from entities
+
+# --- 使い終わったキャラの置き場 ---
+# 消えたキャラ（潰れたクリボー、取られた・マップの外に出たキノコ）をとっておき、次に出す時に使い回す
+# （長く遊んでも、同時にいた数より多くのインスタンスは作らない）
+class EntityPool:
+    def __init__(self, create):
+        self.create = create  # 空の時に新しいインスタンスを作る関数
+        self.free = []
+
+    def acquire(self):
+        # 取り出したインスタンスはspawn()で初期化してから使う
+        if self.free:
+            return self.free.pop()
+        return self.create()
+
+    def release(self, entity):
+        self.free.append(entity)
+
+    def release_all(self, entities):
+        self.free.extend(entities)
+
+# --- キャラ同士の当たり判定（x方向のsweep and prune） ---
+# 左端の順に並べて、x方向に重なっている間のキャラとだけ組を作る
+# （キャラがいくら多くても、調べるのは実際に近くにいる組だけ）
+CONTACT_STOMP = 'stomp'  # マリオがクリボーを上から踏んだ
+CONTACT_HURT = 'hurt'  # マリオがクリボーに当たった
+CONTACT_PICKUP = 'pickup'  # マリオがキノコを取った
+CONTACT_BUMP = 'bump'  # クリボー同士がぶつかった
+
+def _rect_left(entity):
+    return entity.rect.left
+
+def overlapping_pairs(entities):
+    # 矩形が重なっているキャラの組 (a, b) のリストを返す（aの方が左。entitiesは左端の順に並べ替える）
+    entities.sort(key=_rect_left)
+    pairs = []
+    active = []  # これまでのキャラのうち、右端がまだ今のキャラの左端より右にあるもの
+    for entity in entities:
+        rect = entity.rect
+        if active:
+            # 右端が今のキャラの左端まで届かなくなったものを外す（リストを作り直さずにその場で詰める）
+            left = rect.left
+            kept = 0
+            for other in active:
+                if other.rect.right > left:
+                    active[kept] = other
+                    kept += 1
+                    if other.rect.colliderect(rect):
+                        pairs.append((other, entity))
+            del active[kept:]
+        active.append(entity)
+    return pairs
+
+# --- ゲーム本体（ウィンドウなし・フレーム制限なしで回せる） ---
+MARIO_SPAWN_POS = (SCREEN_WIDTH * SCALE // 2, 10 * TILE_SIZE_SCALED)  # マリオの出現位置（rect.midbottom）
+KURIBO_SPAWN_POS = (80 * SCALE, 10 * TILE_SIZE_SCALED)  # 最初からいるクリボーの出現位置
+
+class Game:
+    # snapshot用: ゲーム全体(frame, camera_x, done, クリボーを出現させた列, 状態のあるブロックの数,
+    #              動いている/止まっているキノコの数, 動いている/止まっているクリボーの数) + マリオ
+    STATE_HEADER = struct.Struct("<Ii?iHHHHI" + Mario.STATE_FORMAT)
+    # snapshot用: クリボー1匹分
+    KURIBO_STATE = struct.Struct("<" + Kuribo.STATE_FORMAT)
+    # snapshot用: 状態のある（跳ね上がり中か叩かれた）ブロック1つ分。基準位置で見分ける
+    BLOCK_STATE = struct.Struct("<ii" + Block.STATE_FORMAT)
+
+    def __init__(self, atlas=None, level=None, active_margin=None):
+        # active_margin: キャラを動かす範囲の、画面の左右の余白（ピクセル）。NoneならACTIVE_MARGIN
+        if atlas is None:
+            atlas = load_assets(convert=False, cache_path=ASSET_CACHE_PATH)
+        self.atlas = atlas
+        self.level = level if level is not None else DEFAULT_LEVEL
+        self.active_margin = active_margin if active_margin is not None else ACTIVE_MARGIN
+        self.surface = None  # render()でscreen未指定時に使うオフスクリーン画面
+        self.profiler = None  # profiler.FrameProfiler（Noneなら区間を測らない）
+        self.static_layer = StaticLayer(atlas.image('wall'), self.level)
+        # 画像 -> アトラスの画像番号（draw_list()用。同じSurfaceを共有している名前はどれの番号でもよい）
+        self._frame_ids = {image: index for index, image in enumerate(atlas.frames)}
+        self._keys = ActionKeys()
+        self.mushrooms = []  # 動かしているキノコ
+        self.sleeping_mushrooms = SleepGrid()  # 動かす範囲の外で止まっているキノコ
+        self.kuribos = []  # 動かしているクリボー
+        self.sleeping_kuribos = SleepGrid()  # 動かす範囲の外で止まっているクリボー
+        # (動いているキャラ, 止まっているキャラ) の組（毎フレームタプルを作らないように持っておく）
+        self._entity_groups = ((self.kuribos, self.sleeping_kuribos), (self.mushrooms, self.sleeping_mushrooms))
+        kuribo_images = self._kuribo_images = [atlas.image('kuribo'), atlas.image('kuribo', facing_right=False)]
+        self._mushroom_pool = EntityPool(lambda: Mushroom(atlas.image('mushroom'), 0, 0, None))
+        self._kuribo_pool = EntityPool(lambda: Kuribo(kuribo_images, atlas.image('kuribo_death'), (0, 0), None))
+
+        # 床とブロックの当たり判定グリッド（レベルごとに1回だけ構築。reset()でも作り直さない）
+        self.collision = CollisionGrid(self.level)
+        # ブロックは列がカメラやキャラの近くに来た時に作る（_load_blocks_near）
+        self.blocks = []
+        self._loaded_columns = set()
+        self._pinned_columns = set()  # 叩かれたブロックがあって捨てられない列
+        self._bouncing_blocks = []  # 跳ね上がり中のブロック（update()はこれだけを動かす）
+        self.events = []  # 直前のupdate()で起きた接触 (CONTACT_*, a, b)
+        self.mario = Mario(atlas=atlas, pos=MARIO_SPAWN_POS, collision=self.collision)
+        self._mario_group = (self.mario,)
+        self._contact_entities = [self.mario]  # _resolve_contacts()で毎フレーム並べ直すリスト（使い回す）
+        # マップのピクセル幅
+        self.map_pixel_width = self.level.pixel_width
+        self.reset()
+
+    def reset(self):
+        # 最初の状態に戻す。画像・当たり判定グリッド・作ったブロックやキャラのインスタンスはそのまま使い回し、
+        # 状態だけを戻す（ウィンドウも画像も作り直さないので、学習で何度もリセットしても速い）
+        # 前のキャラはプールに戻す
+        self._mushroom_pool.release_all(self.mushrooms)
+        self._mushroom_pool.release_all(self.sleeping_mushrooms)
+        self.mushrooms.clear()
+        self.sleeping_mushrooms.clear()
+        self._kuribo_pool.release_all(self.kuribos)
+        self._kuribo_pool.release_all(self.sleeping_kuribos)
+        self.kuribos.clear()
+        self.sleeping_kuribos.clear()
+
+        # 作ってあるブロックは叩かれる前の状態に戻す（列は読み込んだまま）
+        self._reset_blocks()
+        self._unload_threshold = MAX_LOADED_COLUMNS  # 読み込んだ列がこれを超えたら捨てる
+        self.events.clear()
+
+        self.mario.spawn(MARIO_SPAWN_POS)
+
+        # クリボー（最初の1匹に加えて、レベルの出現位置の列が近づいたら出てくる）
+        self.sleeping_kuribos.add(self._new_kuribo(KURIBO_SPAWN_POS))
+        self._spawn_frontier = -1  # ここまでの列の出現位置からはクリボーを出した
+
+        # カメラのx座標
+        self.camera_x = 0
+        self.frame = 0
+        self.done = False
+        self._update_active()
+        self._load_blocks_near()
+        return self.observe()
+
+    def _new_kuribo(self, pos):
+        kuribo = self._kuribo_pool.acquire()
+        kuribo.spawn(pos, self.collision)
+        return kuribo
+
+    def _spawn_mushroom(self, x, y):
+        # はてなブロックから呼ばれる（xはブロックの中央、yはブロックの下端）
+        mushroom = self._mushroom_pool.acquire()
+        mushroom.spawn(x, y, self.collision)
+        self.mushrooms.append(mushroom)
+
+    def _off_world(self, entity):
+        # マップの左右の端から出たか、下に落ちた（もう戻ってこない）
+        rect = entity.rect
+        return rect.right <= 0 or rect.left >= self.map_pixel_width or rect.top >= self.level.pixel_height
+
+    def _spawn_kuribos(self, last):
+        # まだ出していない、last列までの出現位置（4）からクリボーを出す
+        level = self.level
+        for col in range(self._spawn_frontier + 1, min(last, level.cols - 1) + 1):
+            column = level.column(col)
+            if 4 not in column:
+                continue
+            for row, t in enumerate(column):
+                if t == 4:
+                    self.sleeping_kuribos.add(self._new_kuribo((col * TILE_SIZE_SCALED + TILE_SIZE_SCALED // 2, (row + 1) * TILE_SIZE_SCALED)))
+        self._spawn_frontier = max(self._spawn_frontier, min(last, level.cols - 1))
+
+    def _active_range(self):
+        # キャラを動かす範囲（左端, 右端）のピクセル座標
+        return self.camera_x - self.active_margin, self.camera_x + SCREEN_WIDTH * SCALE + self.active_margin
+
+    def _update_active(self):
+        # 動かす範囲に合わせて、キャラを止めたり動かしたりする
+        left, right = self._active_range()
+        # クリボーは動かす範囲に出現位置が入った時に出す（出現位置は左から順に使い切る）
+        spawn_last = (right - 1) // TILE_SIZE_SCALED
+        if spawn_last > self._spawn_frontier:
+            self._spawn_kuribos(spawn_last)
+        for awake, sleeping in self._entity_groups:
+            for entity in awake:
+                if entity.rect.right <= left or entity.rect.left >= right:
+                    # 範囲外に出たキャラがいる時だけリストを作り直す
+                    staying = []
+                    for entity in awake:
+                        if entity.rect.right <= left or entity.rect.left >= right:
+                            sleeping.add(entity)
+                        else:
+                            staying.append(entity)
+                    awake[:] = staying
+                    break
+            sleeping.wake(left, right, awake)
+
+    def _load_columns(self, first, last):
+        # first〜last列のブロックをまだ作っていなければ作る
+        loaded = self._loaded_columns
+        level = self.level
+        atlas = self.atlas
+        for col in range(max(first, 0), min(last, level.cols - 1) + 1):
+            if col in loaded:
+                continue
+            loaded.add(col)
+            column = level.column(col)
+            if 2 not in column and 3 not in column:
+                continue
+            for row, t in enumerate(column):
+                if t == 2:
+                    block = Block(atlas.image('block'), col * TILE_SIZE_SCALED, row * TILE_SIZE_SCALED, block_type="normal")
+                elif t == 3:
+                    block = Block(atlas.image('hatena'), col * TILE_SIZE_SCALED, row * TILE_SIZE_SCALED, block_type="hatena", alt_image=atlas.image('panel'), spawn_callback=self._spawn_mushroom)
+                else:
+                    continue
+                self.blocks.append(block)
+                self.collision.add_block(block)
+
+    def _load_blocks_near(self):
+        # カメラの周りと、動いているキャラの周りの列のブロックを用意する
+        first = self.camera_x // TILE_SIZE_SCALED - BLOCK_LOAD_MARGIN
+        last = (self.camera_x + SCREEN_WIDTH * SCALE - 1) // TILE_SIZE_SCALED + BLOCK_LOAD_MARGIN
+        self._load_columns(first, last)
+        # 動いているキャラ（止まっているキャラの周りの列は用意しなくてよい）。
+        # カメラの周りからはみ出しているキャラがいる時だけ範囲のリストを作る
+        ranges = None
+        for entities in (self._mario_group, self.kuribos, self.mushrooms):
+            for entity in entities:
+                rect = entity.rect
+                entity_first = rect.left // TILE_SIZE_SCALED - 1
+                entity_last = (rect.right - 1) // TILE_SIZE_SCALED + 1
+                if entity_first < first or entity_last > last:
+                    self._load_columns(entity_first, entity_last)
+                    if ranges is None:
+                        ranges = [(first, last)]
+                    ranges.append((entity_first, entity_last))
+        if len(self._loaded_columns) - len(self._pinned_columns) > self._unload_threshold:
+            self._unload_columns(ranges or [(first, last)])
+            # キャラが散らばっていて捨てられる列が少なかった時に、毎フレーム調べ直さないようにする
+            self._unload_threshold = max(MAX_LOADED_COLUMNS, len(self._loaded_columns) - len(self._pinned_columns) + MAX_LOADED_COLUMNS // 2)
+
+    def _unload_columns(self, keep):
+        # keepの範囲外で、状態のない（跳ね上がっても叩かれてもいない）ブロックしかない列を捨てる
+        # 捨てた列は次に近づいた時に作り直すので、シミュレーションの結果は変わらない
+        # 叩かれたブロックの列は以後調べない（長いレベルでも毎フレーム調べる列が増えないように）
+        columns = self.collision.columns
+        for col in list(self._loaded_columns - self._pinned_columns):
+            if any(first <= col <= last for first, last in keep):
+                continue
+            blocks = columns.get(col, ())
+            if any(block.used for block in blocks):
+                self._pinned_columns.add(col)
+                continue
+            if any(block.bouncing for block in blocks):
+                continue
+            for block in list(blocks):
+                self.collision.remove_block(block)
+                self.blocks.remove(block)
+            self._loaded_columns.discard(col)
+
+    def _block_at(self, x, y):
+        col = x // TILE_SIZE_SCALED
+        self._load_columns(col, col)
+        for block in self.collision.blocks.get((col, y // TILE_SIZE_SCALED), ()):
+            if block.base_x == x and block.base_y == y:
+                return block
+        raise ValueError("no block at (%d, %d)" % (x, y))
+
+    def snapshot(self):
+        # ゲーム状態を小さなbytesにまとめる（Surfaceやコールバックは含まない。restore()で戻せる）
+        # ブロックは状態のあるものだけを記録する（それ以外は初期状態）。
+        # self.blocksは列を読み込んだ順なので、同じ状態なら同じbytesになるよう位置の順に並べる
+        active_blocks = sorted((block for block in self.blocks if block.bouncing or block.used),
+                               key=lambda block: (block.base_x, block.base_y))
+        values = [self.frame, self.camera_x, self.done, self._spawn_frontier, len(active_blocks),
+                  len(self.mushrooms), self.sleeping_mushrooms.count, len(self.kuribos), self.sleeping_kuribos.count]
+        values += self.mario.get_state()
+        data = self.STATE_HEADER.pack(*values)
+        if active_blocks:
+            pack = self.BLOCK_STATE.pack
+            data += b"".join([pack(block.base_x, block.base_y, *block.get_state()) for block in active_blocks])
+        # キャラは動いているもの（更新する順）、止まっているもの（止めた順）の順に並べる
+        for pack, awake, sleeping in ((Mushroom.STATE.pack, self.mushrooms, self.sleeping_mushrooms),
+                                      (self.KURIBO_STATE.pack, self.kuribos, self.sleeping_kuribos)):
+            if awake:
+                data += b"".join([pack(*entity.get_state()) for entity in awake])
+            if sleeping.count:
+                data += b"".join([pack(*entity.get_state()) for entity in sleeping])
+        return data
+
+    def restore(self, data):
+        # snapshot()の状態に戻す（同じレベルのGameなら別インスタンスのsnapshotでもよい）
+        # 先に全部読んで確かめ、おかしければValueErrorにしてGameは変えない
+        if len(data) < self.STATE_HEADER.size:
+            raise ValueError("snapshot too short: %d bytes" % len(data))
+        values = self.STATE_HEADER.unpack_from(data)
+        block_count, mushroom_count, sleeping_mushroom_count, kuribo_count, sleeping_kuribo_count = values[4:9]
+        size = (self.STATE_HEADER.size + block_count * self.BLOCK_STATE.size
+                + (mushroom_count + sleeping_mushroom_count) * Mushroom.STATE.size
+                + (kuribo_count + sleeping_kuribo_count) * self.KURIBO_STATE.size)
+        if len(data) != size:
+            raise ValueError("snapshot size mismatch: %d bytes, expected %d" % (len(data), size))
+        offset = self.STATE_HEADER.size
+        block_states = []
+        for _ in range(block_count):
+            state = self.BLOCK_STATE.unpack_from(data, offset)
+            offset += self.BLOCK_STATE.size
+            if not self._is_block_position(state[0], state[1]):
+                raise ValueError("no block at (%d, %d) in this level" % (state[0], state[1]))
+            block_states.append(state)
+        mushroom_states = [Mushroom.STATE.unpack_from(data, offset + i * Mushroom.STATE.size)
+                           for i in range(mushroom_count + sleeping_mushroom_count)]
+        offset += len(mushroom_states) * Mushroom.STATE.size
+        kuribo_states = [self.KURIBO_STATE.unpack_from(data, offset + i * self.KURIBO_STATE.size)
+                         for i in range(kuribo_count + sleeping_kuribo_count)]
+        # 画像の番号や大きさは、そのまま使うとset_stateや次の描画で失敗するので先に確かめる
+        mario_state = values[9:]
+        if not 0 <= mario_state[-1] < len(self.atlas.frames):
+            raise ValueError("bad Mario image id: %d" % mario_state[-1])
+        for state in kuribo_states:
+            if not 0 <= state[9] < len(self._kuribo_images):
+                raise ValueError("bad Kuribo frame: %d" % state[9])
+            if state[2] < 0 or state[3] < 0:
+                raise ValueError("bad Kuribo size: %dx%d" % (state[2], state[3]))
+
+        self.frame, self.camera_x, self.done, self._spawn_frontier = values[:4]
+        self.mario.set_state(mario_state)
+
+        # 記録されていないブロックは初期状態に戻す
+        self._reset_blocks()
+        for state in block_states:
+            self._block_at(state[0], state[1]).set_state(state[2:])
+
+        # キノコとクリボーは今あるインスタンスを使い回し、足りなければ作る
+        self._restore_entities(mushroom_states, mushroom_count, self.mushrooms, self.sleeping_mushrooms, self._mushroom_pool)
+        self._restore_entities(kuribo_states, kuribo_count, self.kuribos, self.sleeping_kuribos, self._kuribo_pool)
+        self._bouncing_blocks = [block for block in self.blocks if block.bouncing]
+
+    def _is_block_position(self, x, y):
+        # (x, y) がこのレベルのブロック（タイル2か3）の元の位置か
+        if x % TILE_SIZE_SCALED or y % TILE_SIZE_SCALED:
+            return False
+        col = x // TILE_SIZE_SCALED
+        row = y // TILE_SIZE_SCALED
+        level = self.level
+        return 0 <= col < level.cols and 0 <= row < level.rows and level.column(col)[row] in (2, 3)
+
+    def _reset_blocks(self):
+        # 状態のある（跳ね上がり中か叩かれた）ブロックを初期状態に戻す
+        for block in self.blocks:
+            if block.bouncing or block.used:
+                block.reset_state()
+        self._pinned_columns.clear()
+        self._bouncing_blocks.clear()
+
+    def _restore_entities(self, states, awake_count, awake, sleeping, pool):
+        # snapshotのキャラの並び（先頭のawake_count個が動いているもの、残りが止まっているもの）を戻す
+        instances = awake + list(sleeping)
+        awake.clear()
+        sleeping.clear()
+        pool.release_all(instances[len(states):])
+        for i, state in enumerate(states):
+            entity = instances[i] if i < len(instances) else pool.acquire()
+            entity.collision = self.collision
+            entity.set_state(state)
+            if i < awake_count:
+                awake.append(entity)
+            else:
+                sleeping.add(entity)
+
+    def step(self, action):
+        # 1フレーム進めて (obs, reward, done, info) を返す
+        self._keys.action = action
+        prev_x = self.mario.rect.x
+        if self.update(self._keys) == 'dead':
+            self.done = True
+        # 報酬は右方向への進んだピクセル数
+        reward = float(self.mario.rect.x - prev_x)
+        info = {'frame': self.frame, 'mario_dead': self.mario.dead, 'events': [event[0] for event in self.events]}
+        return self.observe(), reward, self.done, info
+
+    def observe(self):
+        # (マリオのx, y, vx, vy, on_ground, camera_x)。要素数はOBS_SIZE
+        mario = self.mario
+        return (mario.rect.x, mario.rect.y, mario.vx, mario.vy, mario.on_ground, self.camera_x)
 
-        keys = pygame.key.get_pressed()
+    def update(self, keys):
+        # keysはpygame.key.get_pressed()と同じ形（ActionKeysでも可）。マリオの死亡演出が終わると'dead'を返す
+        mario = self.mario
+        collision = self.collision
+        profiler = self.profiler
+        result = None
+        self.frame += 1
+
+        # 動かす範囲の外に出たキャラを止め、範囲に入ったキャラを動かす
+        self._update_active()
+        # 近くの列のブロックを用意する
+        self._load_blocks_near()
+        if profiler is not None:
+            profiler.lap(PHASE_WORLD)
 
         # マリオの更新
+        prev_top = mario.rect.top
         mario_result = mario.update(keys)
         if mario_result == 'dead':
-            running = False
-
-        # クリボーの更新
-        if kuribo.alive:
+            result = 'dead'
+        if profiler is not None:
+            profiler.lap(PHASE_MARIO)
+
+        # クリボーの更新（消えたクリボーと、下に落ちたクリボーはプールに戻す）
+        kuribos = self.kuribos
+        despawned = None
+        for kuribo in kuribos:
             kuribo.update()
-        else:
-            all_sprites.remove(kuribo)
-
-        # マリオとクリボーの当たり判定
-        if kuribo.alive and not kuribo.squashed and not mario.dead and mario.rect.colliderect(kuribo.rect):
-            # マリオが上からクリボーに当たったか判定
-            if mario.vy > 0 and mario.rect.bottom - kuribo.rect.top < 16 * SCALE and mario.rect.centery < kuribo.rect.centery:
-                kuribo.squash()
-                mario.vy = -JUMP_POWER * 0.6
-            else:
-                mario.die()
+            if not kuribo.alive or self._off_world(kuribo):
+                if despawned is None:
+                    despawned = []
+                despawned.append(kuribo)
+        if despawned is not None:
+            self._despawn(kuribos, self._kuribo_pool, despawned)
+        if profiler is not None:
+            profiler.lap(PHASE_ENTITIES)
+
+        # キャラ同士の当たり判定（マリオ・クリボー・キノコ）
+        self._resolve_contacts()
+        if profiler is not None:
+            profiler.lap(PHASE_CONTACTS)
 
         # マリオがブロックを下から叩いたか判定
-        for block in blocks:
+        # 前フレームの頭の位置から現在の頭の位置までに掛かるブロックだけを調べる
+        if mario.vy < 0 and mario.rect.top <= prev_top:
+            head_blocks = collision.blocks_in(mario.rect.left, mario.rect.top - 1, mario.rect.right, prev_top + 1)
+        else:
+            head_blocks = ()
+        for block in head_blocks:
             # マリオの頭がブロックに当たった瞬間のみ跳ね上げる
-            prev_top = mario.rect.top - int(mario.vy)
             # 修正版: prev_topがblock.rect.bottom以上、かつ現在のtopがblock.rect.bottom以下（未満だと1ピクセルのズレで判定されないことがある）
             if (mario.vy < 0 and
                 prev_top >= block.rect.bottom and
                 mario.rect.top <= block.rect.bottom and
                 mario.rect.right > block.rect.left and
                 mario.rect.left < block.rect.right):
-                block.hit_from_below()
+                if not block.bouncing:
+                    block.hit_from_below()
+                    if block.bouncing:
+                        self._bouncing_blocks.append(block)
                 # 跳ね上がり判定後にvyを0にする
                 mario.vy = 0
         # ※床は跳ね上がらない（床はBlockクラスで管理されていない）
-
-        # ブロックの更新
-        for block in blocks:
-            block.update()
-
-        # キノコの更新
+        if profiler is not None:
+            profiler.lap(PHASE_BLOCK_HITS)
+
+        # ブロックの更新（跳ね上がり中のものだけ。止まっているブロックのupdate()は何もしない）
+        bouncing_blocks = self._bouncing_blocks
+        if bouncing_blocks:
+            finished = False
+            for block in bouncing_blocks:
+                block.update()
+                if not block.bouncing:
+                    finished = True
+            if finished:
+                bouncing_blocks[:] = [block for block in bouncing_blocks if block.bouncing]
+        if profiler is not None:
+            profiler.lap(PHASE_BLOCKS)
+
+        # キノコの更新（マップの外に出たキノコはプールに戻す）
+        mushrooms = self.mushrooms
+        despawned = None
         for mushroom in mushrooms:
             mushroom.update()
+            if self._off_world(mushroom):
+                if despawned is None:
+                    despawned = []
+                despawned.append(mushroom)
+        if despawned is not None:
+            self._despawn(mushrooms, self._mushroom_pool, despawned)
 
         # カメラのx座標をマリオ中心で更新
         # マリオが画面中央より右に行ったらカメラを右に動かす
@@ -617,46 +1499,333 @@ def main():
         mario_center_x = mario.rect.centerx
         camera_x = mario_center_x - (SCREEN_WIDTH * SCALE) // 2
         # カメラの範囲をマップ内に制限
-        camera_x = max(0, min(camera_x, map_pixel_width - SCREEN_WIDTH * SCALE))
+        camera_x = max(0, min(camera_x, self.map_pixel_width - SCREEN_WIDTH * SCALE))
+        self.camera_x = camera_x
+        if profiler is not None:
+            profiler.lap(PHASE_ENTITIES)
+        return result
+
+    def _resolve_contacts(self):
+        # 重なっている組ごとに接触を処理して、self.eventsに記録する
+        mario = self.mario
+        events = self.events
+        events.clear()
+        if not self.kuribos and not self.mushrooms:
+            return
+        # 前のフレームのリストを使い回す（並べ替えで順番が変わっているので、マリオ・クリボー・キノコの順に入れ直す）
+        entities = self._contact_entities
+        entities[0] = mario
+        entities[1:] = self.kuribos
+        entities += self.mushrooms
+        picked = None
+        # 踏みつけの判定はループの前のマリオで行う（1体目を踏んで跳ね返っても、同じフレームで重なる2体目も踏める）
+        falling = mario.vy > 0
+        mario_bottom = mario.rect.bottom
+        mario_centery = mario.rect.centery
+        for a, b in overlapping_pairs(entities):
+            if b is mario or (type(a) is Mushroom and type(b) is Kuribo):
+                a, b = b, a  # マリオ、クリボー、キノコの順にそろえる
+            if a is mario:
+                if mario.dead:
+                    continue
+                if type(b) is Kuribo:
+                    kuribo = b
+                    if not kuribo.alive or kuribo.squashed:
+                        continue
+                    # マリオが上からクリボーに当たったか判定
+                    if falling and mario_bottom - kuribo.rect.top < 16 * SCALE and mario_centery < kuribo.rect.centery:
+                        kuribo.squash()
+                        mario.vy = -JUMP_POWER * 0.6
+                        events.append((CONTACT_STOMP, mario, kuribo))
+                    else:
+                        mario.die()
+                        events.append((CONTACT_HURT, mario, kuribo))
+                else:
+                    if picked is None:
+                        picked = []
+                    picked.append(b)
+                    events.append((CONTACT_PICKUP, mario, b))
+            elif type(a) is Kuribo and type(b) is Kuribo:
+                if a.squashed or b.squashed:
+                    continue
+                # 向かい合っていれば互いに反転する（aの方が左）
+                if a.vx > 0:
+                    a.vx = -KURIBO_WALK_SPEED
+                if b.vx < 0:
+                    b.vx = KURIBO_WALK_SPEED
+                events.append((CONTACT_BUMP, a, b))
+            # クリボーとキノコ、キノコ同士はすり抜ける
+        if picked is not None:
+            self._despawn(self.mushrooms, self._mushroom_pool, picked)
+
+    def _despawn(self, entities, pool, removed):
+        # removedのキャラをentitiesから外してプールに戻す（残りの順番は変えない）
+        entities[:] = [entity for entity in entities if entity not in removed]
+        pool.release_all(removed)
+
+    def positions(self):
+        # 補間描画用に、現在のカメラ位置と各スプライトの位置を記録する
+        positions = {}
+        for obj in self.blocks:
+            positions[obj] = (obj.rect.x, obj.rect.y)
+        for obj in self.mushrooms:
+            positions[obj] = (obj.rect.x, obj.rect.y)
+        for obj in self.kuribos:
+            positions[obj] = (obj.rect.x, obj.rect.y)
+        # 止まっているキャラは動かないので記録しなくてよい
+        positions[self.mario] = (self.mario.rect.x, self.mario.rect.y)
+        return self.camera_x, positions
+
+    def render(self, screen=None, alpha=1.0, previous=None):
+        # screenに現在の画面を描画する（省略時はオフスクリーンのSurfaceに描く）
+        # previous（positions()の戻り値）を渡すと、その時点から現在までをalpha(0.0〜1.0)で補間して描く
+        if screen is None:
+            if self.surface is None:
+                self.surface = pygame.Surface((SCREEN_WIDTH * SCALE, SCREEN_HEIGHT * SCALE))
+            screen = self.surface
+        camera_x = self.camera_x
+        positions = None
+        if previous is not None and alpha < 1.0:
+            prev_camera_x, positions = previous
+            camera_x = prev_camera_x + int(round((camera_x - prev_camera_x) * alpha))
+        view_right = camera_x + SCREEN_WIDTH * SCALE
+
+        # 空と床タイルの描画（焼き込み済みチャンクをカメラ分ずらして貼るだけ）
+        # ブロックは下で描画するのでここでは描画しない
+        self.static_layer.draw(screen, camera_x)
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.lap(PHASE_TILES)
+
+        # キノコ・ブロック・クリボー・マリオの順に、カメラ分ずらして描画
+        # 画面に掛からないものは描かない（補間中の1フレーム分のずれを見込んで1タイル広めに見る）
+        blit = screen.blit
+        for obj in self.visible_sprites(camera_x - TILE_SIZE_SCALED, view_right + TILE_SIZE_SCALED):
+            rect = obj.rect
+            x = rect.x
+            y = rect.y
+            if positions is not None:
+                prev = positions.get(obj)
+                if prev is not None:
+                    x = prev[0] + int(round((x - prev[0]) * alpha))
+                    y = prev[1] + int(round((y - prev[1]) * alpha))
+            blit(obj.image, (x - camera_x, y))
+        if profiler is not None:
+            profiler.lap(PHASE_SPRITES)
+        return screen
+
+    def visible_sprites(self, left, right):
+        # x座標がleft〜rightに掛かる、描画するもの（image と rect を持つ）を重ねる順に返す
+        # キノコはブロックより前＝先に描画する
+        for mushroom in self.mushrooms:
+            if mushroom.rect.right > left and mushroom.rect.left < right:
+                yield mushroom
+        yield from self.sleeping_mushrooms.near(left, right)
+        # ブロック（キノコの上に重ねる）。掛かっている列のブロックだけ
+        columns = self.collision.columns
+        for col in range(left // TILE_SIZE_SCALED, (right - 1) // TILE_SIZE_SCALED + 1):
+            for block in columns.get(col, ()):
+                yield block
+        for kuribo in self.kuribos:
+            if kuribo.rect.right > left and kuribo.rect.left < right:
+                yield kuribo
+        yield from self.sleeping_kuribos.near(left, right)
+        yield self.mario
+
+    def draw_list(self):
+        # 今の画面を描くのに要るものだけを (camera_x, ((画像番号, x, y), ...)) にまとめる（画像番号はatlas.framesの添字）
+        # タプルだけでGameを参照しないので、次のtickを進めている間に別のスレッドで描いてよい
+        frame_ids = self._frame_ids
+        camera_x = self.camera_x
+        sprites = tuple([(frame_ids[obj.image], obj.rect.x, obj.rect.y)
+                         for obj in self.visible_sprites(camera_x, camera_x + SCREEN_WIDTH * SCALE)])
+        return camera_x, sprites
+
+def main(ticks_per_frame=1, speed=1.0, fps=60, interpolate=False, record=None, level=None, dirty=False, profile=False,
+         capture=None, capture_format='raw', pipelined=False):
+    # ticks_per_frame: 1描画ごとに進めるtick数（2以上で早送り・コマ飛ばし）
+    #                  Noneにすると実時間に合わせてTICK_RATEで進める（描画が遅くてもゲーム速度は一定）
+    # speed: 実時間に合わせる時のゲーム速度の倍率
+    # fps: 描画のフレームレート上限（0で無制限）
+    # interpolate: 実時間モードで、直前のtickとの間を補間して描画する
+    # record: 指定したファイルに入力を記録する（replay.pyで再生できる。levelを指定した時はreplay.pyにも同じ--levelを渡す）
+    # level: レベルファイル（level_format.py）のパス。Noneなら組み込みのTILEMAP
+    # dirty: 変わったところだけを描き直して、display.update(rects)で出す（interpolateは使えない）
+    # Rキーで最初からやり直す（ウィンドウと画像はそのまま。入力を記録している間は使えない）
+    # profile: 最初から区間ごとの時間を測り、オーバーレイを表示する
+    #          （F3でオーバーレイの表示/非表示、F4で残っている計測結果をprofile_*.csvに書き出す）
+    # capture: 描画した画面を指定したパスに録画する（capture.py。capture_formatは'raw'か'png'）
+    #          書き出しが追いつかないフレームは捨てる。終了時に捨てた割合と1フレームあたりの時間を表示する
+    # pipelined: tickを別スレッドで進め、前のtickの描画リストを描くのと並べて動かす（pipeline.py。入力は1フレーム遅れる）
+    #            dirty・interpolate・profileとは一緒に使えない
+    if dirty and interpolate:
+        raise ValueError("dirty mode cannot be combined with interpolate")
+    if pipelined and (dirty or interpolate or profile):
+        raise ValueError("pipelined mode cannot be combined with dirty, interpolate or profile")
+    if level is not None:
+        from level_format import load_level
+        level = load_level(level)
+    pygame.init()
+    screen = pygame.display.set_mode((SCREEN_WIDTH * SCALE, SCREEN_HEIGHT * SCALE))
+    pygame.display.set_caption("スーパーマリオ風")
 
-        screen.fill((92, 148, 252))  # マリオの空色
+    game = Game(load_assets(), level)
+
+    renderer = None
+    if dirty:
+        from dirty_render import DirtyRenderer
+        renderer = DirtyRenderer(game)
+
+    recorder = None
+    if record is not None:
+        from replay import InputRecorder
+        recorder = InputRecorder(level=game.level)
+
+    profiler = None
+    if profile:
+        from profiler import FrameProfiler
+        profiler = FrameProfiler()
+        profiler.overlay_visible = True
+        game.profiler = profiler
+
+    capturer = None
+    if capture is not None:
+        from capture import FrameCapture
+        capturer = FrameCapture(screen, capture, capture_format)
+
+    simulation = None
+    if pipelined:
+        from pipeline import SimulationThread, draw
+        simulation = SimulationThread(game, recorder)
+        simulation.submit(0, 0)  # 最初の画面の描画リスト
+        reset_requested = False
 
-        # タイルマップの描画（カメラ分ずらす）
-        for y, row in enumerate(TILEMAP):
-            for x, t in enumerate(row):
-                if t == 1:
-                    draw_x = x * TILE_SIZE_SCALED - camera_x
-                    draw_y = y * TILE_SIZE_SCALED
-                    # 画面外は描画しない
-                    if -TILE_SIZE_SCALED < draw_x < SCREEN_WIDTH * SCALE:
-                        screen.blit(wall_img, (draw_x, draw_y))
-                # ブロックはBlockクラスで描画するのでここでは描画しない
-
-        # キノコの描画（ブロックより前＝先に描画）
-        for mushroom in mushrooms:
-            mushroom_draw_rect = mushroom.rect.copy()
-            mushroom_draw_rect.x -= camera_x
-            screen.blit(mushroom.image, mushroom_draw_rect)
-
-        # ブロックの描画（キノコの上に重ねる）
-        for block in blocks:
-            block.draw(screen, camera_x)
-
-        # スプライト描画
-        # マリオとクリボーの描画位置もカメラ分ずらす
-        if kuribo.alive:
-            kuribo_draw_rect = kuribo.rect.copy()
-            kuribo_draw_rect.x -= camera_x
-            screen.blit(kuribo.image, kuribo_draw_rect)
-        mario_draw_rect = mario.rect.copy()
-        mario_draw_rect.x -= camera_x
-        screen.blit(mario.image, mario_draw_rect)
-
-        pygame.display.flip()
-        clock.tick(60)
+    clock = pygame.time.Clock()
+    timestep = FixedTimestep(speed=speed)
+    last_time = time.perf_counter()
+    previous = None
+    running = True
+
+    while running:
+        if profiler is not None:
+            profiler.begin_frame()
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT:
+                running = False
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_r and recorder is None:
+                if simulation is not None:
+                    reset_requested = True  # Gameはシミュレーションスレッドが持っているので、次のtickの前にリセットさせる
+                    continue
+                game.reset()
+                previous = None
+                if renderer is not None:
+                    renderer.invalidate()
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F3 and simulation is None:
+                if profiler is None:
+                    from profiler import FrameProfiler
+                    profiler = FrameProfiler()
+                    game.profiler = profiler
+                    profiler.begin_frame()
+                profiler.overlay_visible = not profiler.overlay_visible
+                if renderer is not None:
+                    renderer.invalidate()  # オーバーレイを消した跡を描き直す
+            elif event.type == pygame.KEYDOWN and event.key == pygame.K_F4 and profiler is not None:
+                path = time.strftime("profile_%Y%m%d_%H%M%S.csv")
+                count = profiler.dump_csv(path)
+                print("%s: %d frames" % (path, count))
+
+        if ticks_per_frame is None:
+            now = time.perf_counter()
+            ticks = timestep.advance(now - last_time)
+            last_time = now
+        else:
+            ticks = ticks_per_frame
+
+        keys = pygame.key.get_pressed()
+        action = action_from_keys(keys)
+        if profiler is not None:
+            profiler.lap(PHASE_INPUT)
+
+        if simulation is not None:
+            # 前のフレームで進め始めたtickの描画リストを受け取り、次のtickを進め始めてから描く
+            draw_list, result = simulation.result()
+            if result == 'dead':
+                running = False
+            else:
+                simulation.submit(action, ticks, reset_requested)
+                reset_requested = False
+            draw(screen, game.atlas.frames, game.static_layer, draw_list)
+            if capturer is not None:
+                capturer.capture(screen)
+            pygame.display.flip()
+            clock.tick(fps)
+            continue
+
+        for tick in range(ticks):
+            if interpolate and tick == ticks - 1:
+                previous = game.positions()
+            result = game.update(keys)
+            if recorder is not None:
+                recorder.record(action, game)
+            if result == 'dead':
+                running = False
+                break
+
+        if renderer is not None:
+            rects = renderer.render(screen)
+            if capturer is not None:
+                capturer.capture(screen)  # オーバーレイは録画しない
+            if profiler is not None:
+                profiler.lap(PHASE_SPRITES)  # 差分描画では空・床の描き直しもspritesに数える
+                overlay = profiler.draw_overlay(screen)
+                if overlay is not None:
+                    # 次のフレームでオーバーレイの下を描き直す
+                    rects.append(overlay)
+                    renderer.invalidate(overlay)
+            pygame.display.update(rects)
+        else:
+            if interpolate and ticks_per_frame is None:
+                game.render(screen, timestep.alpha, previous)
+            else:
+                game.render(screen)
+            if capturer is not None:
+                capturer.capture(screen)
+            if profiler is not None:
+                profiler.draw_overlay(screen)
+            pygame.display.flip()
+        if profiler is not None:
+            profiler.lap(PHASE_FLIP)
+            profiler.end_frame()
+        clock.tick(fps)
+
+    if simulation is not None:
+        simulation.close()
+    if recorder is not None:
+        recorder.save(record)
+    if capturer is not None:
+        capturer.close()
+        print(capturer.summary())
 
     pygame.quit()
     sys.exit()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="スーパーマリオ風")
+    parser.add_argument("--ticks-per-frame", type=int, default=1, help="1描画ごとに進めるtick数（0で実時間に合わせる）")
+    parser.add_argument("--speed", type=float, default=1.0, help="実時間に合わせる時のゲーム速度の倍率")
+    parser.add_argument("--fps", type=int, default=60, help="描画のフレームレート上限（0で無制限）")
+    parser.add_argument("--interpolate", action="store_true", help="tickの間を補間して描画する")
+    parser.add_argument("--record", metavar="FILE", help="入力を記録するファイル")
+    parser.add_argument("--level", metavar="FILE", help="レベルファイル（level_format.pyで作る）")
+    parser.add_argument("--dirty", action="store_true", help="変わったところだけを描き直す")
+    parser.add_argument("--profile", action="store_true", help="区間ごとの時間を測ってオーバーレイに出す（F3/F4）")
+    parser.add_argument("--capture", metavar="PATH", help="画面を録画するファイル（pngならディレクトリ）")
+    parser.add_argument("--capture-format", choices=("raw", "png"), default="raw", help="録画の形式")
+    parser.add_argument("--pipelined", action="store_true", help="tickを別スレッドで進めて、描画と並べて動かす")
+    args = parser.parse_args()
+    if args.dirty and args.interpolate:
+        parser.error("--dirty cannot be combined with --interpolate")
+    if args.pipelined and (args.dirty or args.interpolate or args.profile):
+        parser.error("--pipelined cannot be combined with --dirty, --interpolate or --profile")
+    main(ticks_per_frame=args.ticks_per_frame or None, speed=args.speed, fps=args.fps, interpolate=args.interpolate, record=args.record, level=args.level, dirty=args.dirty, profile=args.profile,
+         capture=args.capture, capture_format=args.capture_format, pipelined=args.pipelined)
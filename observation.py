@@ -0,0 +1,107 @@
+# --- エージェント用の観測をNumPy配列に直接描く ---
+# 画面のSurfaceを経由せず、レベルのタイル・ブロックの状態・キノコ・クリボー・マリオの矩形から
+# 現在のcamera_xで見えている範囲を、あらかじめ確保した配列に書き込む（毎回同じ配列を使い回す）
+#
+# mode:
+#   'grid'    : タイル単位の意味マップ（行数 x 画面の列数、値はTILE_*のコード）
+#   'palette' : downscale分の1に縮小した画面（値はTILE_*のコード）
+#   'gray'    : 'palette'をグレースケール(0〜255)にしたもの
+import numpy as np
+
+from main import SCALE, SCREEN_HEIGHT, SCREEN_WIDTH, TILE_SIZE_SCALED
+
+# 観測の値（意味コード）
+TILE_EMPTY = 0
+TILE_FLOOR = 1
+TILE_BLOCK = 2
+TILE_HATENA = 3
+TILE_PANEL = 4  # 叩かれたはてなブロック
+TILE_MUSHROOM = 5
+TILE_KURIBO = 6
+TILE_MARIO = 7
+
+# 'gray'モードでの明るさ（空は明るく、マリオとクリボーは暗く）
+GRAY_LEVELS = np.array([200, 110, 90, 150, 70, 170, 40, 0], dtype=np.uint8)
+
+class ObservationRenderer:
+    def __init__(self, mode='grid', downscale=8):
+        if mode not in ('grid', 'palette', 'gray'):
+            raise ValueError("unknown observation mode: %r" % (mode,))
+        # 1タイルが観測ピクセルのちょうど整数個になる大きさだけ使える
+        if mode != 'grid' and (downscale < 1 or TILE_SIZE_SCALED % downscale):
+            raise ValueError("downscale must divide the tile size %d: %r" % (TILE_SIZE_SCALED, downscale))
+        self.mode = mode
+        self.view_width = SCREEN_WIDTH * SCALE
+        self.view_height = SCREEN_HEIGHT * SCALE
+        # 1観測ピクセル（gridなら1マス）あたりの画面ピクセル数
+        self.cell = TILE_SIZE_SCALED if mode == 'grid' else downscale
+
+        self.repeat = TILE_SIZE_SCALED // self.cell  # 1タイルあたりの観測ピクセル数
+        self.width = self.view_width // self.cell
+        self.height = self.view_height // self.cell
+        self.buffer = np.zeros((self.height, self.width), dtype=np.uint8)
+        self.gray = np.zeros((self.height, self.width), dtype=np.uint8) if mode == 'gray' else None
+
+    def _fill(self, rect, camera_x, code):
+        # 画面上のrectが掛かる観測ピクセルをcodeで塗る
+        cell = self.cell
+        x0 = (rect.left - camera_x) // cell
+        x1 = -(-(rect.right - camera_x) // cell)
+        y0 = rect.top // cell
+        y1 = -(-rect.bottom // cell)
+        if x0 < 0:
+            x0 = 0
+        if y0 < 0:
+            y0 = 0
+        if x1 > self.width:
+            x1 = self.width
+        if y1 > self.height:
+            y1 = self.height
+        if x0 < x1 and y0 < y1:
+            self.buffer[y0:y1, x0:x1] = code
+
+    def render(self, game):
+        # gameの現在の状態を観測配列に書き込んで返す（返す配列は毎回同じもの）
+        camera_x = game.camera_x
+        cell = self.cell
+        buffer = self.buffer
+
+        # 床（見えている列だけをレベルのデータから読んで拡大する）
+        level = game.level
+        repeat = self.repeat
+        start = camera_x // cell
+        first_col = start // repeat
+        last_col = min((start + self.width - 1) // repeat, level.cols - 1)
+        columns = np.frombuffer(level.data, dtype=np.uint8, count=(last_col - first_col + 1) * level.rows, offset=first_col * level.rows)
+        floor = (columns.reshape(-1, level.rows).T == 1).astype(np.uint8) * TILE_FLOOR
+        if repeat > 1:
+            floor = floor.repeat(repeat, axis=0).repeat(repeat, axis=1)
+        floor = floor[:self.height, start - first_col * repeat:start - first_col * repeat + self.width]
+        buffer[:] = TILE_EMPTY
+        buffer[:floor.shape[0], :floor.shape[1]] = floor
+
+        # Game.renderと同じ順に重ねる（キノコ→ブロック→クリボー→マリオ）
+        view_right = camera_x + self.view_width
+        for mushroom in game.mushrooms:
+            self._fill(mushroom.rect, camera_x, TILE_MUSHROOM)
+        for mushroom in game.sleeping_mushrooms.near(camera_x, view_right):
+            self._fill(mushroom.rect, camera_x, TILE_MUSHROOM)
+        # ブロックは見えている列の分だけ取り出す
+        columns = game.collision.columns
+        for col in range(camera_x // TILE_SIZE_SCALED, (camera_x + self.view_width - 1) // TILE_SIZE_SCALED + 1):
+            for block in columns.get(col, ()):
+                if block.block_type == "hatena":
+                    code = TILE_PANEL if block.used else TILE_HATENA
+                else:
+                    code = TILE_BLOCK
+                self._fill(block.rect, camera_x, code)
+        for kuribo in game.kuribos:
+            self._fill(kuribo.rect, camera_x, TILE_KURIBO)
+        for kuribo in game.sleeping_kuribos.near(camera_x, view_right):
+            self._fill(kuribo.rect, camera_x, TILE_KURIBO)
+        self._fill(game.mario.rect, camera_x, TILE_MARIO)
+
+        if self.gray is not None:
+            np.take(GRAY_LEVELS, buffer, out=self.gray)
+            return self.gray
+        return buffer
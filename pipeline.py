@@ -0,0 +1,119 @@
+# --- シミュレーションと描画を並べて動かす（パイプライン） ---
+# Gameのtickは別スレッド（シミュレーションスレッド）で進め、tickを進め終えるたびにGame.draw_list()
+# （画像番号と位置だけのタプル）を渡す。描画側はそのタプルだけを見て描くので、
+# tick N+1を進めている間にtick Nの画面を描ける（pygameのblitや画面への転送はGILを手放すので、2つのコアを使える）
+#
+# ウィンドウとイベントはメインスレッドでしか扱えないことがあるので、描画と入力はメインスレッドに残し、
+# シミュレーションの方を別スレッドに出す。入力が画面に出るのは1フレーム遅れる。
+# 補間描画・差分描画・区間タイマーには対応しない
+#
+#   python pipeline.py [シナリオ] [フレーム数] : ウィンドウなしでbench.pyのシナリオを回し、
+#                                              順番に動かした時とパイプラインの時のフレーム/秒を比べる
+import os
+import queue
+import sys
+import threading
+import time
+
+from main import ActionKeys
+
+class SimulationThread:
+    def __init__(self, game, recorder=None):
+        # recorder: replay.InputRecorder（tickごとにシミュレーションスレッドで記録する）
+        self.game = game
+        self.recorder = recorder
+        self._commands = queue.SimpleQueue()  # (action, tick数, 先にリセットするか)。Noneで終わり
+        self._results = queue.SimpleQueue()  # (描画リスト, Game.updateの結果) か (None, 例外)
+        self._thread = threading.Thread(target=self._run, name="Simulation", daemon=True)
+        self._thread.start()
+
+    def submit(self, action, ticks=1, reset=False):
+        # tickを進め始める（結果はresult()で受け取る。submitとresultは交互に呼ぶ）
+        self._commands.put((action, ticks, reset))
+
+    def result(self):
+        # submit()したtickを進め終えるまで待って (描画リスト, 'dead'かNone) を返す
+        draw_list, result = self._results.get()
+        if draw_list is None:
+            raise result
+        return draw_list, result
+
+    def close(self):
+        if self._thread is None:
+            return
+        self._commands.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        game = self.game
+        recorder = self.recorder
+        keys = ActionKeys()
+        while True:
+            command = self._commands.get()
+            if command is None:
+                break
+            action, ticks, reset = command
+            try:
+                if reset:
+                    game.reset()
+                keys.action = action
+                result = None
+                for _ in range(ticks):
+                    result = game.update(keys)
+                    if recorder is not None:
+                        recorder.record(action, game)
+                    if result == 'dead':
+                        break
+                self._results.put((game.draw_list(), result))
+            except Exception as e:
+                self._results.put((None, e))
+
+def draw(screen, frames, static_layer, draw_list):
+    # Game.draw_list()の結果をscreenに描く（framesはatlas.frames、static_layerはGame.static_layer）
+    camera_x, sprites = draw_list
+    static_layer.draw(screen, camera_x)
+    blit = screen.blit
+    for image_id, x, y in sprites:
+        blit(frames[image_id], (x - camera_x, y))
+
+def _benchmark(name, frames_count):
+    # シナリオを順番に動かした時とパイプラインの時の、1秒あたりのフレーム数を返す
+    import pygame
+
+    from bench import SCENARIOS
+    from main import SCALE, SCREEN_HEIGHT, SCREEN_WIDTH, Game
+
+    _, make_level, script, _, options = SCENARIOS[name]
+    level = make_level() if make_level is not None else None
+    screen = pygame.Surface((SCREEN_WIDTH * SCALE, SCREEN_HEIGHT * SCALE))
+    game = Game(None, level, **options)
+    keys = ActionKeys()
+    start = time.perf_counter()
+    for frame in range(frames_count):
+        keys.action = script(frame)
+        game.update(keys)
+        game.render(screen)
+    sequential = frames_count / (time.perf_counter() - start)
+
+    game = Game(game.atlas, level, **options)
+    simulation = SimulationThread(game)
+    frames = game.atlas.frames
+    start = time.perf_counter()
+    simulation.submit(script(0))
+    for frame in range(1, frames_count + 1):
+        draw_list, _ = simulation.result()
+        if frame < frames_count:
+            simulation.submit(script(frame))
+        draw(screen, frames, game.static_layer, draw_list)
+    pipelined = frames_count / (time.perf_counter() - start)
+    simulation.close()
+    return sequential, pipelined
+
+if __name__ == "__main__":
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    name = sys.argv[1] if len(sys.argv) > 1 else 'dash'
+    frames_count = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    sequential, pipelined = _benchmark(name, frames_count)
+    print("sequential: %8.0f frames/s" % sequential)
+    print("pipelined : %8.0f frames/s" % pipelined)
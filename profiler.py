@@ -0,0 +1,114 @@
+# --- フレームごとの区間タイマー ---
+# main()のループとGame.update/renderの区切りごとにlap()を呼び、直前のlap()からの時間を区間ごとに足していく。
+# 1フレーム分の合計は固定サイズのリングバッファに残し、p50/p99の表示（F3）やCSVへの書き出し（F4）に使う
+#
+# Game.profilerがNoneの間は、各区切りで「is not None」を1回調べるだけなのでほぼ無料
+import time
+from array import array
+
+import pygame
+
+# 区間（lap()に渡す番号）
+PHASE_INPUT = 0  # イベント処理とキー入力
+PHASE_WORLD = 1  # キャラの停止・再開、ブロックの列の用意
+PHASE_MARIO = 2  # マリオの移動と当たり判定
+PHASE_ENTITIES = 3  # クリボーとキノコの移動と当たり判定
+PHASE_CONTACTS = 4  # キャラ同士の当たり判定
+PHASE_BLOCK_HITS = 5  # マリオがブロックを下から叩いたかの判定
+PHASE_BLOCKS = 6  # ブロックの跳ね上がり
+PHASE_TILES = 7  # 空と床の描画
+PHASE_SPRITES = 8  # ブロックとキャラの描画
+PHASE_FLIP = 9  # 画面への転送（display.flip/update）
+PHASES = ("input", "world", "mario", "entities", "contacts", "block_hits", "blocks", "tiles", "sprites", "flip")
+
+OVERLAY_REFRESH = 30  # オーバーレイの数字を描き直す間隔（フレーム数）
+
+class FrameProfiler:
+    def __init__(self, capacity=600):
+        self.capacity = capacity
+        self.samples = array('d', bytes(8 * capacity * len(PHASES)))  # 1フレーム分（秒）ずつ区間の数だけ並べる
+        self.frames = 0  # これまでに記録したフレーム数
+        self._current = [0.0] * len(PHASES)
+        self._last = time.perf_counter()
+        self._perf_counter = time.perf_counter
+        self.overlay_visible = False
+        self._overlay = None
+        self._overlay_frame = -OVERLAY_REFRESH
+        self._font = None
+
+    def begin_frame(self):
+        self._last = self._perf_counter()
+
+    def lap(self, phase):
+        # 直前のlap()（かbegin_frame()）からの時間をphaseに足す
+        now = self._perf_counter()
+        self._current[phase] += now - self._last
+        self._last = now
+
+    def end_frame(self):
+        current = self._current
+        samples = self.samples
+        start = self.frames % self.capacity * len(current)
+        for i, value in enumerate(current):
+            samples[start + i] = value
+            current[i] = 0.0
+        self.frames += 1
+
+    def recent(self):
+        # 残っているフレームを古い順に、1フレーム分（秒）のリストのリストで返す
+        count = len(PHASES)
+        rows = [self.samples[i * count:(i + 1) * count].tolist() for i in range(min(self.frames, self.capacity))]
+        if self.frames > self.capacity:
+            start = self.frames % self.capacity
+            rows = rows[start:] + rows[:start]
+        return rows
+
+    def percentiles(self):
+        # {区間名: (p50, p99)}（ミリ秒）。最後に合計も入れる
+        rows = self.recent()
+        if not rows:
+            return {}
+        result = {}
+        columns = list(zip(*rows))
+        columns.append([sum(row) for row in rows])
+        for name, values in zip(PHASES + ("total",), columns):
+            values = sorted(values)
+            last = len(values) - 1
+            result[name] = (values[last * 50 // 100] * 1000.0, values[last * 99 // 100] * 1000.0)
+        return result
+
+    def dump_csv(self, path):
+        # 残っているフレームをCSVに書き出す（ミリ秒）。書き出したフレーム数を返す
+        rows = self.recent()
+        first = self.frames - len(rows)
+        with open(path, "w") as f:
+            f.write("frame," + ",".join(PHASES) + ",total\n")
+            for i, row in enumerate(rows):
+                f.write("%d,%s,%.4f\n" % (first + i, ",".join("%.4f" % (value * 1000.0) for value in row), sum(row) * 1000.0))
+        return len(rows)
+
+    def draw_overlay(self, screen):
+        # 区間ごとのp50/p99を左上に描き、描いた矩形を返す（非表示ならNone）
+        if not self.overlay_visible:
+            return None
+        if self._overlay is None or self.frames - self._overlay_frame >= OVERLAY_REFRESH:
+            self._overlay = self._render_overlay()
+            self._overlay_frame = self.frames
+        return screen.blit(self._overlay, (4, 4))
+
+    def _render_overlay(self):
+        if self._font is None:
+            if not pygame.font.get_init():
+                pygame.font.init()
+            self._font = pygame.font.Font(None, 18)
+        font = self._font
+        lines = ["%-10s %6s %6s" % ("phase(ms)", "p50", "p99")]
+        for name, (p50, p99) in self.percentiles().items():
+            lines.append("%-10s %6.3f %6.3f" % (name, p50, p99))
+        line_height = font.get_linesize()
+        width = max(font.size(line)[0] for line in lines) + 8
+        surface = pygame.Surface((width, line_height * len(lines) + 8), pygame.SRCALPHA)
+        surface.fill((0, 0, 0, 160))
+        for i, line in enumerate(lines):
+            surface.blit(font.render(line, True, (255, 255, 255)), (4, 4 + i * line_height))
+        return surface
@@ -0,0 +1,160 @@
+# --- 入力の記録と最高速での再生 ---
+# 1フレームごとのaction（LEFT/RIGHT/JUMP/DASHのビット）をランレングス圧縮して小さなバイナリに記録し、
+# ウィンドウなしのGameに流し込んで最高速で再生する。
+# 記録時に一定間隔でマリオの位置も残しておくと、再生時に同じ位置になるかを確かめられる
+#
+# ファイル形式（整数はlittle endian）:
+#   ヘッダ: MAGIC(4バイト), バージョン(uint8), フレーム数(uint32), 位置記録の間隔(uint16), 連の数(uint32), 位置記録の数(uint32)
+#   レベル: 記録した時のレベルの行数(uint16), 列数(uint32)（バージョン2の記録にはなく、組み込みのレベルとみなす）
+#   連: action(uint8) + 長さ(LEB128の可変長整数) を連の数だけ
+#   位置記録: (x, y) をint32で位置記録の数だけ
+import argparse
+import struct
+import sys
+import time
+
+from main import DEFAULT_LEVEL, ActionKeys, Game
+
+MAGIC = b"MRPL"
+VERSION = 3  # 2: 位置を端数付きで進めるようになった（1の記録は位置が合わないので読まない）、3: レベルの大きさを記録する
+HEADER = struct.Struct("<4sBIHII")
+LEVEL_SIZE = struct.Struct("<HI")
+POSITION = struct.Struct("<ii")
+
+class ReplayMismatch(Exception):
+    pass
+
+class InputRecorder:
+    def __init__(self, checkpoint_interval=60, level=None):
+        # level: 記録するGameのLevel（省略時は組み込みのレベル）
+        self.checkpoint_interval = checkpoint_interval  # 0で位置を記録しない
+        if level is None:
+            level = DEFAULT_LEVEL
+        self.level_size = (level.rows, level.cols)
+        self.runs = []  # [action, 連の長さ]
+        self.frames = 0
+        self.checkpoints = []
+
+    def record(self, action, game=None):
+        # そのフレームのactionを記録する（gameはupdate後に渡すと位置も記録される）
+        if self.runs and self.runs[-1][0] == action:
+            self.runs[-1][1] += 1
+        else:
+            self.runs.append([action, 1])
+        self.frames += 1
+        if game is not None and self.checkpoint_interval and self.frames % self.checkpoint_interval == 0:
+            self.checkpoints.append((game.mario.rect.x, game.mario.rect.y))
+
+    def to_bytes(self):
+        out = bytearray(HEADER.pack(MAGIC, VERSION, self.frames, self.checkpoint_interval, len(self.runs), len(self.checkpoints)))
+        out += LEVEL_SIZE.pack(*self.level_size)
+        for action, length in self.runs:
+            out.append(action)
+            while True:
+                byte = length & 0x7F
+                length >>= 7
+                if length:
+                    out.append(byte | 0x80)
+                else:
+                    out.append(byte)
+                    break
+        for x, y in self.checkpoints:
+            out += POSITION.pack(x, y)
+        return bytes(out)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_bytes())
+
+class Replay:
+    def __init__(self, data):
+        magic, version, self.frames, self.checkpoint_interval, run_count, checkpoint_count = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version not in (2, VERSION):
+            raise ValueError("not a replay file")
+        pos = HEADER.size
+        if version == 2:
+            self.level_size = (DEFAULT_LEVEL.rows, DEFAULT_LEVEL.cols)
+        else:
+            self.level_size = LEVEL_SIZE.unpack_from(data, pos)
+            pos += LEVEL_SIZE.size
+        self.runs = []  # (action, 連の長さ)
+        for _ in range(run_count):
+            action = data[pos]
+            pos += 1
+            length = 0
+            shift = 0
+            while True:
+                byte = data[pos]
+                pos += 1
+                length |= (byte & 0x7F) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+            self.runs.append((action, length))
+        self.checkpoints = [POSITION.unpack_from(data, pos + i * POSITION.size) for i in range(checkpoint_count)]
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def actions(self):
+        # 1フレームずつactionを返す
+        for action, length in self.runs:
+            for _ in range(length):
+                yield action
+
+    def play(self, game=None, verify=True, level=None):
+        # ウィンドウなしで最高速で再生して、再生し終えたGameを返す（gameを省略した時はlevelのGameを作る）
+        # verify=Trueなら記録された位置と食い違った時点でReplayMismatch。
+        # 記録した時と大きさの違うレベルのGameならReplayMismatch
+        if game is None:
+            game = Game(None, level)
+        else:
+            game.reset()
+        if (game.level.rows, game.level.cols) != self.level_size:
+            raise ReplayMismatch("recorded on a %dx%d level, replaying on %dx%d" % (
+                self.level_size + (game.level.rows, game.level.cols)))
+        keys = ActionKeys()
+        checkpoints = self.checkpoints if verify else ()
+        interval = self.checkpoint_interval
+        frame = 0
+        for action, length in self.runs:
+            keys.action = action
+            for _ in range(length):
+                game.update(keys)
+                frame += 1
+                if interval and frame % interval == 0 and frame // interval <= len(checkpoints):
+                    expected = checkpoints[frame // interval - 1]
+                    actual = (game.mario.rect.x, game.mario.rect.y)
+                    if actual != expected:
+                        raise ReplayMismatch("frame %d: recorded %r, replayed %r" % (frame, expected, actual))
+        return game
+
+if __name__ == "__main__":
+    # python replay.py 記録ファイル... [--level FILE] : すべて再生して位置を確かめる
+    parser = argparse.ArgumentParser(description="入力の記録を再生して位置を確かめる")
+    parser.add_argument("paths", nargs="*", metavar="FILE", help="記録ファイル")
+    parser.add_argument("--level", metavar="FILE", help="記録した時のレベルファイル（省略時は組み込みのレベル）")
+    args = parser.parse_args()
+    level = None
+    if args.level is not None:
+        from level_format import load_level
+        level = load_level(args.level)
+    game = Game(None, level)
+    total_frames = 0
+    start = time.perf_counter()
+    failed = False
+    for path in args.paths:
+        replay = Replay.load(path)
+        try:
+            replay.play(game)
+            print("%s: %d frames OK" % (path, replay.frames))
+        except ReplayMismatch as e:
+            print("%s: MISMATCH %s" % (path, e))
+            failed = True
+        total_frames += replay.frames
+    elapsed = time.perf_counter() - start
+    if total_frames:
+        print("%d frames in %.2fs (%.0f frames/s)" % (total_frames, elapsed, total_frames / elapsed))
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,160 @@
+# --- 複数プロセスでのロールアウト ---
+# ウィンドウなしのGameを持つワーカープロセスを並べ、行動・観測・報酬・終了フラグを
+# multiprocessing.shared_memory上のリングバッファでやり取りする。
+# 親からワーカーへは「どのスロットで何をするか」の数バイトだけを送り、観測はpickleしない
+#
+# 共有メモリの1スロット（num_envs個の環境分）:
+#   actions uint8[num_envs] | obs float64[num_envs, OBS_SIZE] | reward float64[num_envs] | done uint8[num_envs]
+# スロットはring_size個あり、step()ごとに次のスロットを使う（直前の結果は次のstepの間も読める）
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from main import ASSET_CACHE_PATH, OBS_SIZE, Game, load_assets
+
+CMD_RESET = 0
+CMD_STEP = 1
+CMD_CLOSE = 2
+COMMAND = struct.Struct("<BI")  # コマンド, スロット番号
+
+def _slot_layout(num_envs):
+    # スロット内の各配列の (dtype, shape, オフセット) とスロットのバイト数
+    layout = []
+    offset = 0
+    for dtype, shape in ((np.uint8, (num_envs,)), (np.float64, (num_envs, OBS_SIZE)), (np.float64, (num_envs,)), (np.uint8, (num_envs,))):
+        offset += -offset % 8
+        layout.append((dtype, shape, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    offset += -offset % 8
+    return layout, offset
+
+def _ring_arrays(buf, num_envs, ring_size):
+    # スロットごとの (actions, obs, reward, done) のビュー
+    layout, slot_size = _slot_layout(num_envs)
+    ring = []
+    for slot in range(ring_size):
+        base = slot * slot_size
+        ring.append(tuple(np.ndarray(shape, dtype, buf, base + offset) for dtype, shape, offset in layout))
+    return ring
+
+def _worker(conn, shm, first, count, num_envs, ring_size):
+    atlas = load_assets(convert=False, cache_path=ASSET_CACHE_PATH)
+    games = [Game(atlas) for _ in range(count)]
+    ring = _ring_arrays(shm.buf, num_envs, ring_size)
+    try:
+        while True:
+            cmd, slot = COMMAND.unpack(conn.recv_bytes())
+            if cmd == CMD_CLOSE:
+                break
+            actions, obs, reward, done = ring[slot]
+            for env, game in enumerate(games, first):
+                if cmd == CMD_RESET:
+                    obs[env] = game.reset()
+                    reward[env] = 0.0
+                    done[env] = False
+                else:
+                    observation, r, d, _ = game.step(int(actions[env]))
+                    # 終わった環境はその場でリセットして、次の観測を返す
+                    if d:
+                        observation = game.reset()
+                    obs[env] = observation
+                    reward[env] = r
+                    done[env] = d
+            conn.send_bytes(b"\0")
+    finally:
+        del ring
+        conn.close()
+
+class RolloutPool:
+    def __init__(self, num_workers=None, envs_per_worker=1, ring_size=2):
+        if num_workers is None:
+            num_workers = os.cpu_count()
+        self.num_envs = num_workers * envs_per_worker
+        self.ring_size = ring_size
+        _, slot_size = _slot_layout(self.num_envs)
+        self._shm = shared_memory.SharedMemory(create=True, size=slot_size * ring_size)
+        self._ring = _ring_arrays(self._shm.buf, self.num_envs, ring_size)
+        self._slot = 0
+
+        # forkでワーカーを作る（共有メモリのオブジェクトをそのまま引き継ぐ。Linux向け）
+        ctx = multiprocessing.get_context("fork")
+        self._conns = []
+        self._workers = []
+        for w in range(num_workers):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker, args=(child_conn, self._shm, w * envs_per_worker, envs_per_worker, self.num_envs, ring_size), daemon=True)
+            process.start()
+            child_conn.close()
+            self._conns.append(parent_conn)
+            self._workers.append(process)
+
+    def _send(self, cmd):
+        message = COMMAND.pack(cmd, self._slot)
+        for conn in self._conns:
+            conn.send_bytes(message)
+
+    def _wait(self):
+        for conn in self._conns:
+            conn.recv_bytes()
+        _, obs, reward, done = self._ring[self._slot]
+        return obs, reward, done
+
+    def reset(self):
+        # 全環境をリセットして観測（共有メモリ上のビュー）を返す
+        self._slot = (self._slot + 1) % self.ring_size
+        self._send(CMD_RESET)
+        obs, _, _ = self._wait()
+        return obs
+
+    def step_async(self, actions):
+        # 次のスロットに行動を書き込んでワーカーに送る（結果はstep_wait()で受け取る）
+        self._slot = (self._slot + 1) % self.ring_size
+        self._ring[self._slot][0][:] = actions
+        self._send(CMD_STEP)
+
+    def step_wait(self):
+        # (obs, reward, done) を返す。どれも共有メモリ上のビューで、ring_size回後のstepで上書きされる
+        return self._wait()
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        if self._shm is None:
+            return
+        message = COMMAND.pack(CMD_CLOSE, 0)
+        for conn in self._conns:
+            conn.send_bytes(message)
+            conn.close()
+        for process in self._workers:
+            process.join()
+        del self._ring
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+if __name__ == "__main__":
+    # python rollout.py [ワーカー数...] : ワーカー数ごとのスループットを測る
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, os.cpu_count()]
+    for num_workers in counts:
+        with RolloutPool(num_workers, envs_per_worker=8) as pool:
+            pool.reset()
+            actions = np.random.default_rng(0).integers(0, 16, size=pool.num_envs, dtype=np.uint8)
+            steps = 500
+            start = time.perf_counter()
+            for _ in range(steps):
+                pool.step(actions)
+            elapsed = time.perf_counter() - start
+            print("%3d workers: %10.0f env-steps/s" % (num_workers, pool.num_envs * steps / elapsed))
@@ -0,0 +1,275 @@
+# --- 別プロセスのエージェントから操作するためのサーバー ---
+# asyncioでUnixソケットかlocalhostのTCPを待ち受け、小さなバイナリのリクエストでウィンドウなしのGameを動かす。
+# 1つのプロセスで複数のGameを持ち、どの接続からもgame idで指定して動かせる。
+# 1回のリクエストでactionの列を渡してその数だけtickを進め、観測や状態をまとめて返すので、
+# 60fpsのループを待たずに1往復数十マイクロ秒で回せる。
+# クライアントは返事を待たずに次のリクエストを送ってよい（届いた順に処理し、同じ順に返す）
+#
+# リクエスト/レスポンス（整数はlittle endian）:
+#   ヘッダ: タグ(uint32), コマンドかステータス(uint8), ペイロードの種類(uint8), game id(uint16), 本体の長さ(uint32)
+#   本体:
+#     CMD_OPEN    : レベルファイルのパス（UTF-8。空なら組み込みのTILEMAP）-> ペイロード（game idはレスポンスのヘッダ）
+#     CMD_RESET   : なし                                                  -> ペイロード
+#     CMD_STEP    : action(uint8)の列                                      -> STEP_RESULT + ペイロード
+#     CMD_RESTORE : Game.snapshot()のbytes                                 -> ペイロード
+#     CMD_CLOSE   : なし                                                  -> なし
+#   タグはクライアントが決め、レスポンスにそのまま返す。エラーの時はステータスSTATUS_ERRORで本体がメッセージ（UTF-8）
+#
+#   python server.py --unix /tmp/mario.sock   : Unixソケットで待ち受ける
+#   python server.py --port 7000              : localhostのTCPで待ち受ける
+import argparse
+import asyncio
+import socket
+import struct
+
+from main import ASSET_CACHE_PATH, Game, load_assets
+
+HEADER = struct.Struct("<IBBHI")
+STEP_RESULT = struct.Struct("<Idb")  # 進めたtick数, 報酬の合計, 終わったか
+OBSERVATION = struct.Struct("<iidd?i")  # Game.observe()と同じ並び
+MAX_BODY = 1 << 24  # これより長い本体のリクエストが来たら接続を切る
+
+CMD_OPEN = 0
+CMD_RESET = 1
+CMD_STEP = 2
+CMD_RESTORE = 3
+CMD_CLOSE = 4
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+# ペイロードの種類（リクエストで指定した種類をレスポンスで返す）
+PAYLOAD_NONE = 0
+PAYLOAD_OBS = 1  # OBSERVATION
+PAYLOAD_STATE = 2  # Game.snapshot()
+PAYLOAD_GRID = 3  # observation.ObservationRenderer('grid')のタイル単位の意味マップ（行数 x 画面の列数のuint8）
+
+class ServerError(Exception):
+    pass
+
+class GameServer:
+    # Gameの表とリクエストの処理（ソケットには触らない）
+    def __init__(self, atlas=None):
+        if atlas is None:
+            atlas = load_assets(convert=False, cache_path=ASSET_CACHE_PATH)
+        self.atlas = atlas
+        self.games = {}  # game id -> Game
+        self.levels = {}  # レベルファイルのパス -> Level（同じファイルのGameでメモリマップを共有する）
+        self._next_id = 0
+        self._grid = None
+
+    def handle(self, command, kind, game_id, body):
+        # 1つのリクエストを処理して (game id, 本体) を返す。失敗したらServerError
+        # （ペイロードの種類はGameを動かす前に確かめる。エラーを返したリクエストはGameを変えない）
+        if kind > PAYLOAD_GRID:
+            raise ServerError("unknown payload kind: %d" % kind)
+        if command == CMD_OPEN:
+            try:
+                path = bytes(body).decode()
+            except UnicodeDecodeError as e:
+                raise ServerError("bad level path: %s" % e)
+            game_id = self._open(path)
+            return game_id, self._payload(self.games[game_id], kind)
+        game = self.games.get(game_id)
+        if game is None:
+            raise ServerError("unknown game id: %d" % game_id)
+        if command == CMD_STEP:
+            return game_id, self._step(game, body) + self._payload(game, kind)
+        if command == CMD_RESET:
+            game.reset()
+        elif command == CMD_RESTORE:
+            try:
+                game.restore(body)
+            except (struct.error, ValueError) as e:
+                raise ServerError("bad snapshot: %s" % e)
+        elif command == CMD_CLOSE:
+            del self.games[game_id]
+            return game_id, b""
+        else:
+            raise ServerError("unknown command: %d" % command)
+        return game_id, self._payload(game, kind)
+
+    def _open(self, path):
+        level = None
+        if path:
+            level = self.levels.get(path)
+            if level is None:
+                from level_format import load_level
+                try:
+                    level = self.levels[path] = load_level(path)
+                except (OSError, ValueError) as e:
+                    raise ServerError("cannot load level %s: %s" % (path, e))
+        # 次の空いているidを使う（閉じたidは一回りしてから使い回す）
+        if len(self.games) >= 0x10000:
+            raise ServerError("too many games")
+        while self._next_id in self.games:
+            self._next_id = (self._next_id + 1) & 0xFFFF
+        game_id = self._next_id
+        self.games[game_id] = Game(self.atlas, level)
+        return game_id
+
+    def _step(self, game, actions):
+        # actionsを1つずつ進める。途中で終わったらそこで止める（続けるにはCMD_RESETを送る）
+        ticks = 0
+        reward = 0.0
+        if not game.done:
+            step = game.step
+            for action in actions:
+                _, r, done, _ = step(action)
+                ticks += 1
+                reward += r
+                if done:
+                    break
+        return STEP_RESULT.pack(ticks, reward, game.done)
+
+    def _payload(self, game, kind):
+        if kind == PAYLOAD_NONE:
+            return b""
+        if kind == PAYLOAD_OBS:
+            return OBSERVATION.pack(*game.observe())
+        if kind == PAYLOAD_STATE:
+            return game.snapshot()
+        if self._grid is None:
+            from observation import ObservationRenderer
+            self._grid = ObservationRenderer('grid')
+        return self._grid.render(game).tobytes()
+
+class _Connection(asyncio.Protocol):
+    # 1つの接続。届いたデータから完全なリクエストを全部取り出して処理し、レスポンスをまとめて1回で書く
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.buffer = bytearray()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        buffer = self.buffer
+        buffer += data
+        handle = self.server.handle
+        responses = []
+        offset = 0
+        while len(buffer) - offset >= HEADER.size:
+            tag, command, kind, game_id, length = HEADER.unpack_from(buffer, offset)
+            if length > MAX_BODY:
+                self.transport.close()
+                return
+            end = offset + HEADER.size + length
+            if end > len(buffer):
+                break
+            body = bytes(buffer[offset + HEADER.size:end])
+            offset = end
+            try:
+                game_id, payload = handle(command, kind, game_id, body)
+            except Exception as e:
+                # 想定していない例外でも接続は続け、同じデータで届いた他のリクエストの返事も返す
+                message = (str(e) if isinstance(e, ServerError) else "%s: %s" % (type(e).__name__, e)).encode()
+                responses.append(HEADER.pack(tag, STATUS_ERROR, kind, game_id, len(message)) + message)
+            else:
+                responses.append(HEADER.pack(tag, STATUS_OK, kind, game_id, len(payload)) + payload)
+        del buffer[:offset]
+        if responses:
+            self.transport.write(b"".join(responses))
+
+async def serve(server, unix=None, host="127.0.0.1", port=7000):
+    # serverのGameを、unixのパスかhost:portで待ち受けて動かす（止めるまで戻らない）
+    loop = asyncio.get_running_loop()
+    if unix is not None:
+        listener = await loop.create_unix_server(lambda: _Connection(server), unix)
+    else:
+        listener = await loop.create_server(lambda: _Connection(server), host, port)
+    async with listener:
+        await listener.serve_forever()
+
+# --- クライアント（ブロッキングのソケット） ---
+class GameClient:
+    def __init__(self, unix=None, host="127.0.0.1", port=7000):
+        if unix is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(unix)
+        else:
+            self.sock = socket.create_connection((host, port))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buffer = bytearray()
+        self._tag = 0
+
+    def send(self, command, game_id=0, body=b"", kind=PAYLOAD_OBS):
+        # リクエストを送ってタグを返す（返事はreceive()で受け取る。返事を待たずに続けて送ってよい）
+        self._tag = (self._tag + 1) & 0xFFFFFFFF
+        self.sock.sendall(HEADER.pack(self._tag, command, kind, game_id, len(body)) + body)
+        return self._tag
+
+    def receive(self):
+        # 次のレスポンスを (タグ, ペイロードの種類, game id, 本体) で返す。エラーならServerError
+        header = self._read(HEADER.size)
+        tag, status, kind, game_id, length = HEADER.unpack(header)
+        body = self._read(length)
+        if status != STATUS_OK:
+            raise ServerError(body.decode())
+        return tag, kind, game_id, body
+
+    def _read(self, size):
+        buffer = self._buffer
+        while len(buffer) < size:
+            chunk = self.sock.recv(max(65536, size - len(buffer)))
+            if not chunk:
+                raise ConnectionError("server closed the connection")
+            buffer += chunk
+        data = bytes(buffer[:size])
+        del buffer[:size]
+        return data
+
+    def request(self, command, game_id=0, body=b"", kind=PAYLOAD_OBS):
+        self.send(command, game_id, body, kind)
+        return self.receive()
+
+    def open(self, level_path="", kind=PAYLOAD_OBS):
+        # 新しいGameを作って (game id, ペイロード) を返す
+        _, kind, game_id, body = self.request(CMD_OPEN, 0, level_path.encode(), kind)
+        return game_id, decode_payload(kind, body)
+
+    def reset(self, game_id, kind=PAYLOAD_OBS):
+        _, kind, _, body = self.request(CMD_RESET, game_id, b"", kind)
+        return decode_payload(kind, body)
+
+    def step(self, game_id, actions, kind=PAYLOAD_OBS):
+        # actions（0〜255の整数の列）の数だけ進めて (進めたtick数, 報酬の合計, 終わったか, ペイロード) を返す
+        _, kind, _, body = self.request(CMD_STEP, game_id, bytes(actions), kind)
+        ticks, reward, done = STEP_RESULT.unpack_from(body)
+        return ticks, reward, bool(done), decode_payload(kind, body[STEP_RESULT.size:])
+
+    def restore(self, game_id, state, kind=PAYLOAD_OBS):
+        _, kind, _, body = self.request(CMD_RESTORE, game_id, state, kind)
+        return decode_payload(kind, body)
+
+    def close_game(self, game_id):
+        self.request(CMD_CLOSE, game_id, b"", PAYLOAD_NONE)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def decode_payload(kind, body):
+    # PAYLOAD_OBSはGame.observe()と同じタプル、それ以外はbytesのまま
+    if kind == PAYLOAD_OBS:
+        return OBSERVATION.unpack(body)
+    if kind == PAYLOAD_NONE:
+        return None
+    return body
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="別プロセスからGameを動かすサーバー")
+    parser.add_argument("--unix", metavar="PATH", help="Unixソケットのパス（省略時はTCP）")
+    parser.add_argument("--host", default="127.0.0.1", help="TCPで待ち受けるアドレス")
+    parser.add_argument("--port", type=int, default=7000, help="TCPのポート")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(GameServer(), unix=args.unix, host=args.host, port=args.port))
+    except KeyboardInterrupt:
+        pass